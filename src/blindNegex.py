@@ -1,6 +1,9 @@
+import os
 import re
 import json
+from bisect import bisect_left
 from tqdm import tqdm
+from parallel import parallel_map
 
 # Function to read negations from a file and store them in a dictionary
 def read_negations(file_path):
@@ -15,8 +18,35 @@ def read_negations(file_path):
 def new_tag(start, end, labels, id):
     return {'value': {'start': start, 'end': end, 'labels': labels}, 'id': 'ent'+str(id), 'from_name': 'label', 'to_name': 'text', 'type': 'labels'}
 
+# Sorted offsets of the sentence boundaries of a text, to resolve scopes with a binary search
+class BoundaryIndex:
+    def __init__(self, text, boundaries=(".",)):
+        self.text = text
+        self.boundaries = set(boundaries)
+        pattern = "[" + "".join(re.escape(boundary) for boundary in self.boundaries) + "]"
+        self.offsets = [match.start() for match in re.finditer(pattern, text)]
+
+    # Same result as fordward_scope, the index before the next boundary (or before the last character),
+    # never before start_index so a cue at the end of a sentence or text gets an empty scope
+    def forward(self, start_index):
+        i = bisect_left(self.offsets, start_index)
+        end_index = self.offsets[i] if i < len(self.offsets) else len(self.text) - 1
+        return max(end_index - 1, start_index)
+
+    # Same result as backward_scope, the index after the previous boundary (or the beginning)
+    def backward(self, end_index):
+        if end_index < len(self.text) and self.text[end_index] in self.boundaries:
+            return end_index
+        i = bisect_left(self.offsets, end_index) - 1
+        return self.offsets[i] + 1 if i >= 0 else 0
+
 # Function to find the end index of the forward scope of a tagged text
-def fordward_scope(tagged_text, start_index):
+def fordward_scope(tagged_text, start_index, boundary_index=None):
+    if boundary_index is not None:
+        return boundary_index.forward(start_index)
+    # A cue at the very end of the text has an empty scope
+    if start_index >= len(tagged_text) - 1:
+        return start_index
     end_index = start_index
     tagger_checker = tagged_text[end_index]
     
@@ -25,10 +55,12 @@ def fordward_scope(tagged_text, start_index):
         end_index += 1
         tagger_checker = tagged_text[end_index]
     
-    return end_index - 1
+    return max(end_index - 1, start_index)
 
 # Function to find the start index of the backward scope of a tagged text
-def backward_scope(tagged_text, end_index):
+def backward_scope(tagged_text, end_index, boundary_index=None):
+    if boundary_index is not None:
+        return boundary_index.backward(end_index)
     start_index = end_index
     tagger_checker = tagged_text[start_index]
     
@@ -42,59 +74,90 @@ def backward_scope(tagged_text, end_index):
     
     return start_index
 
+# Matcher that finds the occurrences of all the negations in a single pass over the text
+class CueMatcher:
+    def __init__(self, negations):
+        self.negations = negations
+        # Character trie of the negations, the None key marks the end of a negation
+        self.trie = {}
+        for negation in negations:
+            node = self.trie
+            for char in negation:
+                node = node.setdefault(char, {})
+            node[None] = negation
+
+    # Function to find the occurrences of every negation, as re.finditer(r'\bnegation\b', text) would
+    def find_all(self, text):
+        # Word boundaries, the only positions where a negation can start or end
+        boundaries = {match.start() for match in re.finditer(r'\b', text)}
+        candidates = {}
+
+        # Walk the trie from each boundary
+        for start in sorted(boundaries):
+            node = self.trie
+            end = start
+            while end < len(text) and text[end] in node:
+                node = node[text[end]]
+                end += 1
+                if None in node and end in boundaries:
+                    candidates.setdefault(node[None], []).append((start, end))
+
+        # Like re.finditer, keep only non-overlapping occurrences of the same negation
+        occurrences = dict()
+        for negation in self.negations:
+            last_end = -1
+            for start, end in candidates.get(negation, []):
+                if start >= last_end:
+                    occurrences.setdefault(negation, []).append((start, end))
+                    last_end = end
+        return occurrences
+
 # Function to tag negations in the text
-def tag_negations(text, negations):
+def tag_negations(text, negations, matcher=None, boundaries=(".",)):
     result = []
-    negations_of_the_text = dict()
-    
-    # Iterate over each negation in the negations dictionary
-    for negation in negations:
-        pattern = r'\b' + re.escape(negation) + r'\b'
-        if re.search(pattern, text):
-            tag = negations[negation]
-            negations_of_the_text[negation] = tag
+    if matcher is None:
+        matcher = CueMatcher(negations)
+
+    # Index the sentence boundaries once for all the scopes of the text
+    boundary_index = BoundaryIndex(text, boundaries)
+
+    # Find all occurrences of each negation in the text, in the order of the negations dictionary
+    negations_of_the_text = matcher.find_all(text)
             
     i = 0
     
     # Iterate over each negation found in the text
-    for negation in negations_of_the_text:
-        pattern = r'\b' + re.escape(negation) + r'\b'
+    for negation, negation_occurrences in negations_of_the_text.items():
         tag = negations[negation]
         
-        # Find all occurrences of the negation in the text
-        negation_occurrences = re.finditer(pattern, text)
-        
         # Iterate over each occurrence of the negation
-        for match in negation_occurrences:
+        for start, end in negation_occurrences:
             # Add a new tag object for the negation occurrence
             if tag[-2] == "P":
-                result.append(new_tag(match.start(), match.end(), ['UNC'], i))
+                result.append(new_tag(start, end, ['UNC'], i))
             else:
-                result.append(new_tag(match.start(), match.end(), ['NEG'], i))
+                result.append(new_tag(start, end, ['NEG'], i))
             i += 1
         
-        # Find all occurrences of the negation in the text
-        negation_occurrences = re.finditer(pattern, text)
-        
         # Iterate over each occurrence of the negation for scope tagging
-        for match in negation_occurrences:
+        for match_start, match_end in negation_occurrences:
             # Determine the scope tag based on the negation tag
             if tag == '[PREN]':
                 scope_tag = '[NSCO]'
-                start_index = match.end()
-                end_index = fordward_scope(text, start_index)
+                start_index = match_end
+                end_index = fordward_scope(text, start_index, boundary_index)
             elif tag == '[PREP]':
                 scope_tag = '[USCO]'
-                start_index = match.end()
-                end_index = fordward_scope(text, start_index)
+                start_index = match_end
+                end_index = fordward_scope(text, start_index, boundary_index)
             elif tag == '[POST]':
                 scope_tag = '[NSCO]'
-                end_index = match.start()
-                start_index = backward_scope(text, end_index)
+                end_index = match_start
+                start_index = backward_scope(text, end_index, boundary_index)
             elif tag == '[POSP]':
                 scope_tag = '[USCO]'
-                end_index = match.start()
-                start_index = backward_scope(text, end_index)
+                end_index = match_start
+                start_index = backward_scope(text, end_index, boundary_index)
             
             # Add a new tag object for the scope of the negation
             result.append(new_tag(start_index, end_index, [scope_tag], i))
@@ -103,19 +166,171 @@ def tag_negations(text, negations):
     return result
 
 # Function to process text data
-def process_text(data, negations, output_file):
+def process_text(data, negations, output_file, boundaries=(".",)):
     copy_json_object = data
     
     # Reset predictions result list for each data item
     for i in range(len(copy_json_object)):
         copy_json_object[i]["predictions"][0]["result"] = []
     
+    # Build the negations matcher once for all the data
+    matcher = CueMatcher(negations)
+
     # Iterate over each data item
     for i in tqdm(range(len(data))):
         text = data[i]["data"]["text"]
-        result = tag_negations(text, negations)
+        result = tag_negations(text, negations, matcher, boundaries)
         copy_json_object[i]["predictions"][0]["result"].extend(result)
     
     # Write updated data to output file
     with open(output_file, "w") as json_file:
         json.dump(copy_json_object, json_file)
+
+# Function to build the context of a parallel worker, the matcher is built once per worker
+def _init_tagger(negations, boundaries):
+    return negations, CueMatcher(negations), boundaries
+
+# Function to tag a text in a parallel worker
+def _tag_text(text, context):
+    negations, matcher, boundaries = context
+    return tag_negations(text, negations, matcher, boundaries)
+
+# Function to process text data over a pool of processes, writes the same file as process_text.
+# Returns the throughput stats of each worker.
+def process_text_parallel(data, negations, output_file, n_workers=None, chunk_size=16, boundaries=(".",)):
+    texts = [item["data"]["text"] for item in data]
+    results, stats = parallel_map(_tag_text, texts, _init_tagger, (negations, boundaries),\
+                                  n_workers=n_workers, chunk_size=chunk_size, verbose=True)
+
+    # Results come back in the same order as the data
+    for item, result in zip(data, results):
+        item["predictions"][0]["result"] = result
+
+    # Write updated data to output file
+    with open(output_file, "w") as json_file:
+        json.dump(data, json_file)
+    return stats
+
+# Function to iterate over the items of a JSON array file (opened as UTF-8 text with newline="") without loading it whole,
+# with the byte offset after each item. A non-zero offset (given by a previous iteration) resumes after that item
+def iter_json_array(file, offset=0, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    file.seek(offset)
+    buffer = file.read(chunk_size)
+    pos = 0
+    started = offset > 0
+    read_size = chunk_size
+
+    while True:
+        # Skip whitespace, separators and the opening bracket
+        skipped = pos
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == "," or (buffer[pos] == "[" and not started)):
+            started = started or buffer[pos] == "["
+            pos += 1
+        offset += len(buffer[skipped:pos].encode("utf8"))
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        # Decode the next item, reading more text if it is incomplete
+        try:
+            if pos == len(buffer):
+                raise json.JSONDecodeError("Empty buffer", buffer, pos)
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            chunk = file.read(read_size)
+            if not chunk:
+                if pos == len(buffer) and not started:
+                    return
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            # Grow the reads so long items are not decoded again too many times
+            read_size *= 2
+            continue
+
+        offset += len(buffer[pos:end].encode("utf8"))
+        yield item, offset
+        pos = end
+        read_size = chunk_size
+        # Drop the consumed text
+        if pos > chunk_size:
+            buffer = buffer[pos:]
+            pos = 0
+
+# Function to iterate over the items of a JSON lines file, with the byte offset after each item
+def iter_json_lines(file, offset=0):
+    file.seek(offset)
+    for line in iter(file.readline, b""):
+        offset += len(line)
+        if line.strip():
+            yield json.loads(line), offset
+
+# Function to read a checkpoint of process_stream
+def read_checkpoint(checkpoint_file):
+    try:
+        with open(checkpoint_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"documents": 0, "input_offset": 0, "output_offset": 0}
+
+# Function to atomically write a checkpoint of process_stream
+def write_checkpoint(checkpoint_file, checkpoint):
+    with open(checkpoint_file + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+# Function to process a Label Studio export as a stream, with bounded memory.
+# Files ending in .jsonl are read / written as JSON lines, other files as a JSON array
+# (the output is then the same file process_text would write).
+# If checkpoint_file is given, progress is saved every checkpoint_every documents and
+# a new call with the same arguments resumes from the last checkpoint.
+def process_stream(input_file, output_file, negations, checkpoint_file=None, checkpoint_every=100, boundaries=(".",)):
+    input_lines = input_file.endswith(".jsonl")
+    output_lines = output_file.endswith(".jsonl")
+    checkpoint = {"documents": 0, "input_offset": 0, "output_offset": 0}
+    if checkpoint_file is not None:
+        checkpoint = read_checkpoint(checkpoint_file)
+    if not os.path.exists(output_file):
+        # Nothing to resume without the output, start over
+        checkpoint = {"documents": 0, "input_offset": 0, "output_offset": 0}
+    resume = checkpoint["documents"] > 0
+
+    # Build the negations matcher once for all the data
+    matcher = CueMatcher(negations)
+
+    # newline="" keeps "\r\n" untranslated so the offsets of iter_json_array are byte positions
+    with open(input_file, "rb" if input_lines else "r", encoding=None if input_lines else "utf8",
+              newline=None if input_lines else "") as in_file, \
+            open(output_file, "r+b" if resume else "wb") as out_file:
+        # Discard whatever was written after the checkpoint
+        out_file.truncate(checkpoint["output_offset"])
+        out_file.seek(checkpoint["output_offset"])
+
+        # Skip the documents already processed
+        if input_lines:
+            documents = iter_json_lines(in_file, checkpoint["input_offset"])
+        else:
+            documents = iter_json_array(in_file, checkpoint["input_offset"])
+
+        n = checkpoint["documents"]
+        input_offset = checkpoint["input_offset"]
+        for item, input_offset in tqdm(documents, initial=n):
+            # Tag the document and write it right away
+            item["predictions"][0]["result"] = tag_negations(item["data"]["text"], negations, matcher, boundaries)
+            if output_lines:
+                out_file.write((json.dumps(item) + "\n").encode("utf8"))
+            else:
+                out_file.write((("[" if n == 0 else ", ") + json.dumps(item)).encode("utf8"))
+            n += 1
+
+            # Save progress
+            if checkpoint_file is not None and n % checkpoint_every == 0:
+                out_file.flush()
+                write_checkpoint(checkpoint_file, {"documents": n, "input_offset": input_offset, "output_offset": out_file.tell()})
+
+        if not output_lines:
+            out_file.write(b"[]" if n == 0 else b"]")
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return n
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional
+import registry
+
+class PreprocessingCache:
+	def __init__(
+			self,
+			cache_dir: str,
+			versions: Optional[Dict[str, Optional[str]]] = None,
+			trust_legacy: bool = False,
+			verbose: bool = False
+	):
+		"""
+		Content-addressed cache of preprocessing artifacts (tokens, POS tags, lemmas...).
+		Each document is stored separately, keyed by a hash of its text, the kind of artifact,
+		the preprocessing options and the spacy versions, so changing any of them invalidates
+		only the affected entries and unchanged documents are never recomputed.
+		Parameters:
+		- cache_dir: directory where the entries are stored.
+		- versions: versions included in the keys. Defaults to registry.spacy_versions().
+		- trust_legacy: whether artifact files without manifest (created before the cache
+			existed) are assumed to be fresh instead of stale.
+		"""
+		self.cache_dir = cache_dir
+		self.versions = versions if versions is not None else registry.spacy_versions()
+		self.trust_legacy = trust_legacy
+		self.verbose = verbose
+		self.hits = 0
+		self.misses = 0
+
+	def doc_key(
+			self,
+			doc: Dict[str, Any],
+			kind: str,
+			options: Dict[str, Any]
+	) -> str:
+		"""
+		Returns the key of the artifact of a Label Studio document.
+		"""
+		payload = json.dumps({
+			"text": doc["data"]["text"],
+			"kind": kind,
+			"options": options,
+			"versions": self.versions
+		}, sort_keys=True)
+		return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+	def keys(
+			self,
+			data: List[Dict[str, Any]],
+			kind: str,
+			options: Dict[str, Any]
+	) -> List[str]:
+		return [self.doc_key(doc, kind, options) for doc in data]
+
+	def _entry_path(
+			self,
+			kind: str,
+			key: str
+	) -> str:
+		return os.path.join(self.cache_dir, kind, key[:2], key + ".json")
+
+	def map(
+			self,
+			data: List[Dict[str, Any]],
+			kind: str,
+			options: Dict[str, Any],
+			compute: Callable[[List[int]], List[Any]],
+			encode: Callable[[Any], Any] = lambda x: x,
+			decode: Callable[[Any], Any] = lambda x: x,
+			manifest_path: Optional[str] = None
+	) -> List[Any]:
+		"""
+		Returns the artifact of every document, reusing the cached ones.
+		Parameters:
+		- data: the documents.
+		- kind: name of the artifact.
+		- options: preprocessing options the artifact depends on.
+		- compute: function that receives the indices of the documents missing in the cache
+			and returns their artifacts, in the same order.
+		- encode / decode: conversion of an artifact to / from JSON.
+		- manifest_path: if given, the keys are written to a manifest for that file
+			(see is_fresh).
+		"""
+		keys = self.keys(data, kind, options)
+		results = [None] * len(data)
+		missing = []
+		for i, key in enumerate(keys):
+			path = self._entry_path(kind, key)
+			if os.path.exists(path):
+				with open(path, "r", encoding="utf8") as f:
+					results[i] = decode(json.load(f))
+			else:
+				missing.append(i)
+		self.hits += len(data) - len(missing)
+		self.misses += len(missing)
+		if self.verbose: print(f"Cache {kind}: {len(data) - len(missing)} hits, {len(missing)} misses")
+		if missing:
+			for i, result in zip(missing, compute(missing)):
+				results[i] = result
+				path = self._entry_path(kind, keys[i])
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				with open(path, "w", encoding="utf8") as f:
+					json.dump(encode(result), f)
+		if manifest_path is not None:
+			self.write_manifest(manifest_path, keys)
+		return results
+
+	@staticmethod
+	def manifest_path(
+			path: str
+	) -> str:
+		return path + ".manifest"
+
+	def write_manifest(
+			self,
+			path: str,
+			keys: List[str]
+	) -> None:
+		"""
+		Record the keys of the documents an artifact file was built from.
+		"""
+		with open(self.manifest_path(path), "w", encoding="utf8") as f:
+			json.dump(keys, f)
+
+	def has_manifest(
+			self,
+			path: str
+	) -> bool:
+		return os.path.exists(self.manifest_path(path))
+
+	def is_fresh(
+			self,
+			path: str,
+			data: List[Dict[str, Any]],
+			kind: str,
+			options: Dict[str, Any]
+	) -> bool:
+		"""
+		Check if an artifact file was built from the given documents, options and versions.
+		Files without manifest (created before the cache existed) can not be checked and are
+		stale, unless trust_legacy is set.
+		"""
+		if not os.path.exists(path):
+			return False
+		if not self.has_manifest(path):
+			return self.trust_legacy
+		with open(self.manifest_path(path), "r", encoding="utf8") as f:
+			return json.load(f) == self.keys(data, kind, options)
+
+	def stats(self) -> Dict[str, float]:
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / max(1, self.hits + self.misses)
+		}
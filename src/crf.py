@@ -3,37 +3,58 @@ from preprocessing import *
 import os
 import nltk
 import string
+import hashlib
+import random
+from time import time
+from parallel import parallel_map
 
 ROOT_DIR = os.path.dirname(os.path.abspath(""))
 
+DEFAULT_SPECIAL_WORDS = ["nada", "ni", "nunca", "ningun", "ninguno", "ninguna", "alguna", "apenas", "para_nada", "ni_siquiera"]
+PAD_TOKEN = "<PAD>"
+# CRF parameters the features depend on, the others are passed to the trainer
+FEATURE_PARAMS = ("padding", "before_lim", "after_lim", "special_words")
+# Evaluation options that may come with the CRF parameters, used by neither
+EVAL_PARAMS = ("save_results",)
+
+# Label Studio tag of each BIO label
+LABEL_TAGS = {"B-NEG": "NEG", "I-NEG": "NEG", "B-NSCO": "NSCO", "I-NSCO": "NSCO",\
+		"B-UNC": "UNC", "I-UNC": "UNC", "B-USCO": "USCO", "I-USCO": "USCO"}
+
 def put_bio(
 		data: List[Dict[str, Any]],
 		data_tokens: List[List[Dict[str, Any]]],
 		train_data_bio: List[List[List[str]]]
 ):
+	"""
+	Writes the BIO tags of the annotated spans of each document into train_data_bio.
+	The tokens completely inside a span are tagged, only in the first sentence that
+	reaches the span. The spans of a document are looked up together in a SpanIndex.
+	"""
 	tags = {"NEG": ["B-NEG", "I-NEG"], "NSCO": ["B-NSCO", "I-NSCO"],\
 		 	"UNC": ["B-UNC", "I-UNC"], "USCO": ["B-USCO", "I-USCO"]}
 
-	for d, doc in enumerate(data_tokens): 
-		res_spans = data[d]["predictions"][0]["result"]
-		for res_span in res_spans:
-			span_tag = res_span["value"]["labels"][0]
-			if span_tag in tags:
-				start = res_span["value"]["start"]
-				end = res_span["value"]["end"]
-				for s, sent in enumerate(doc):
-					# Check if res_span is in this sentence
-					if not sent["spans"].any(axis=None) or sent["spans"][0][0] > end or sent["spans"][-1][-1] < start:
-						continue
-					# Find the span in the sentence
-					found = False
-					for i, span in enumerate(sent["spans"]):
-						if span[0] >= start and span[1] <= end:
-							train_data_bio[d][s][i] = tags[span_tag][found]
-							found = True
-						elif found: # found and we are out of the span
-							break
-					break # we found the sentence
+	for d, doc in enumerate(data_tokens):
+		res_spans = [res_span["value"] for res_span in data[d]["predictions"][0]["result"]\
+			   if res_span["value"]["labels"][0] in tags]
+		if not res_spans:
+			continue
+		span_index = SpanIndex(doc)
+		starts = np.array([value["start"] for value in res_spans])
+		ends = np.array([value["end"] for value in res_spans])
+		# first token reaching each span, and the tokens completely inside it
+		first, _ = span_index.query_batch(starts, ends)
+		lo, hi = span_index.query_batch(starts, ends, truncate=True)
+		for value, f, l, h in zip(res_spans, first, lo, hi):
+			if f == len(span_index.starts):
+				continue
+			s = span_index.sent_ids[f]
+			sent_start, sent_end = span_index.sent_offsets[s], span_index.sent_offsets[s + 1]
+			if span_index.starts[sent_start] > value["end"]:
+				continue
+			begin, end = int(max(l, sent_start)), int(min(h, sent_end))
+			for i in range(begin, end):
+				train_data_bio[d][s][i - sent_start] = tags[value["labels"][0]][i > begin]
 
 def create_bio_tags(
 		data: List[Dict[str, Any]],
@@ -46,6 +67,27 @@ def create_bio_tags(
 	put_bio(data, data_tokens, data_bio)
 	return data_bio
 
+def compute_pos(
+		tokens: List[List[Dict[str, Any]]],
+		nlps: Optional[Tuple[Any, Any]] = None,
+		verbose: bool = False
+) -> List[List[List[str]]]:
+	"""
+	Computes POS tags for the given tokens. NER and parser are skipped.
+	"""
+	if nlps is None:
+		nlps = load_nlps("tagger")
+	nlp_es, nlp_ca = nlps
+	pos = []
+	for doc in tqdm(tokens, total=len(tokens), disable=not verbose):
+		doc_pos = []
+		for sentence in doc:
+			nlp = nlp_ca if sentence["lang"] == "ca" else nlp_es
+			doc = run_pipes(nlp, " ".join(sentence["tokens"]))
+			doc_pos.append([token.pos_ for token in doc])
+		pos.append(doc_pos)
+	return pos
+
 def precompute_pos(
 		tokens_path: str,
 		pos_path: str,
@@ -54,25 +96,577 @@ def precompute_pos(
 	"""
 	Precomputes POS tags for the given tokens and saves them to a file.
 	"""
-	nlp_es, nlp_ca = load_nlps()
 	pos_dir = os.path.dirname(pos_path)
 	if not os.path.exists(pos_dir):
 		os.makedirs(pos_dir)
-	tokens = load_tokens(tokens_path)
-	pos = []
-	for doc in tqdm(tokens, total=len(tokens), disable=not verbose):
-		doc_pos = []
-		for sentence in doc:
-			lang = sentence["lang"]
-			if lang == "ca":
-				doc = nlp_ca(" ".join(sentence["tokens"]))
-			else:
-				doc = nlp_es(" ".join(sentence["tokens"]))
-			doc_pos.append([token.pos_ for token in doc])
-		pos.append(doc_pos)
+	pos = compute_pos(load_tokens(tokens_path), verbose=verbose)
 	with open(pos_path, "w") as f:
 		json.dump(pos, f)
 
+class FeatureExtractor:
+	def __init__(
+			self,
+			padding: bool = False,
+			before_lim: int = 6,
+			after_lim: int = 1,
+			special_words: Optional[List[str]] = None
+	):
+		"""
+		Builds the CRF features of the words of a sentence (see CRF.word2features).
+		The word shape and affix features only depend on the word, so they are computed once
+		per vocabulary item and cached; only the contextual n-gram features are built per
+		position.
+		"""
+		self.padding = padding
+		self.before_lim = before_lim
+		self.after_lim = after_lim
+		self.special_words = list(special_words if special_words is not None else DEFAULT_SPECIAL_WORDS)
+		self._special_words = set(self.special_words)
+		self._punctuation = set(string.punctuation)
+		self._static = {}
+
+	def params(self) -> Dict[str, Any]:
+		"""
+		Returns the parameters the features depend on.
+		"""
+		return {
+			"padding": self.padding,
+			"before_lim": self.before_lim,
+			"after_lim": self.after_lim,
+			"special_words": self.special_words
+		}
+
+	def key(self) -> str:
+		"""
+		Returns a short hash of the parameters, to name precomputed features.
+		"""
+		return hashlib.sha1(json.dumps(self.params(), sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+	def static_features(
+			self,
+			word: str
+	) -> Tuple[str, ...]:
+		"""
+		Returns the features that only depend on the word: the word itself followed by its
+		shape and affix features.
+		"""
+		features = self._static.get(word)
+		if features is None:
+			chars = set(word)
+			features = [
+				"word=" + word,
+				"is_first_capital=" + str(word[0].isupper()),
+				"is_alphanumeric=" + str(word.isalnum()),
+				"has_num=" + str(any(char.isdigit() for char in word)),
+				"has_cap=" + str(any(char.isupper() for char in word)),
+				"has_dash=" + str('-' in chars),
+				"has_us=" + str('_' in chars),
+				"has_punctuation=" + str(not chars.isdisjoint(self._punctuation)),
+				"is_special=" + str(word.lower() in self._special_words)
+			]
+			# suffix and prefix features for lengths of 2, 3, and 4
+			features.extend(f"suffix-{length}=" + word[-length:] for length in (2, 3, 4) if len(word) >= length)
+			features.extend(f"prefix-{length}=" + word[:length] for length in (2, 3, 4) if len(word) >= length)
+			features = tuple(features)
+			self._static[word] = features
+		return features
+
+	def features(
+			self,
+			words: List[str],
+			pos: List[str],
+			idx: int
+	) -> List[str]:
+		"""
+		Returns the features of the word at position idx of a sentence.
+		"""
+		word = words[idx]
+		static = self.static_features(word)
+		features = ["bias", static[0], "pos=" + pos[idx]]
+		features.extend(static[1:])
+
+		if self.padding:
+			# always self.before_lim bigram features, using padding if there are not enough previous words
+			features.extend(f"2GRAMBEFORE_{j}={words[idx - j] if idx >= j else PAD_TOKEN}_{word}"\
+				for j in range(1, self.before_lim + 1))
+		else:
+			# bigram features for up to self.before_lim words before the current word
+			features.extend(f"2GRAMBEFORE={words[j]}_{word}" for j in range(max(0, idx - self.before_lim), idx))
+
+		# bigram features for up to self.after_lim words after the current word
+		for j in range(1, self.after_lim + 1):
+			if idx + j < len(words):
+				features.append(f"2GRAMAFTER_{j}={word}_{words[idx + j]}")
+			elif self.padding:
+				features.append(f"2GRAMAFTER_{j}={word}_{PAD_TOKEN}")
+
+		# beforepos
+		for i in range(1, self.before_lim + 1):
+			if idx - i >= 0:
+				features.append(f'BEFOREPOS-{i}=' + words[idx - i])
+			elif self.padding:
+				features.append(f'BEFOREPOS-{i}=START')
+
+		# afterpos
+		for i in range(1, self.after_lim + 1):
+			if idx + i < len(words):
+				features.append(f'AFTERPOS-{i}=' + words[idx + i])
+			elif self.padding:
+				features.append(f'AFTERPOS-{i}=END')
+
+		return features
+
+	def sent_features(
+			self,
+			words: List[str],
+			pos: List[str]
+	) -> List[List[str]]:
+		"""
+		Returns the features of every word of a sentence.
+		"""
+		words = [str(word) for word in words]
+		return [self.features(words, pos, i) for i in range(len(words))]
+
+	def corpus_features(
+			self,
+			sents: List[Tuple[List[str], List[str]]],
+			verbose: bool = False
+	) -> List[List[List[str]]]:
+		"""
+		Returns the features of every sentence of a corpus, given as (words, pos) pairs.
+		"""
+		return [self.sent_features(words, pos) for words, pos in tqdm(sents, disable=not verbose)]
+
+def corpus_hash(
+		sents: List[Tuple[List[str], List[str]]]
+) -> str:
+	"""
+	Returns a hash of the words and POS tags of a corpus.
+	"""
+	sha = hashlib.sha1()
+	for words, pos in sents:
+		sha.update(json.dumps([[str(word) for word in words], list(pos)]).encode("utf-8"))
+	return sha.hexdigest()
+
+def save_features(
+		features: List[List[List[str]]],
+		path: str,
+		meta: Optional[Dict[str, Any]] = None
+) -> None:
+	"""
+	Save the feature sequences of a corpus to a directory with the distinct feature strings
+	in vocab.json, meta.json and one .npy file per column:
+	- feature_ids: int32 index into vocab of every feature of the corpus.
+	- item_offsets: int64 offset of the first feature of every item (plus the end).
+	- seq_offsets: int64 offset of the first item of every sequence (plus the end).
+	"""
+	if not os.path.exists(path):
+		os.makedirs(path)
+	vocab = {}
+	feature_ids, item_offsets, seq_offsets = [], [0], [0]
+	for xseq in features:
+		for item in xseq:
+			feature_ids.extend(vocab.setdefault(feature, len(vocab)) for feature in item)
+			item_offsets.append(len(feature_ids))
+		seq_offsets.append(len(item_offsets) - 1)
+	with open(os.path.join(path, "vocab.json"), "w") as f:
+		json.dump(list(vocab), f)
+	np.save(os.path.join(path, "feature_ids.npy"), np.array(feature_ids, dtype=np.int32))
+	np.save(os.path.join(path, "item_offsets.npy"), np.array(item_offsets, dtype=np.int64))
+	np.save(os.path.join(path, "seq_offsets.npy"), np.array(seq_offsets, dtype=np.int64))
+	# written last, so a directory with meta.json is complete
+	with open(os.path.join(path, "meta.json"), "w") as f:
+		json.dump(meta or {}, f)
+
+def load_features_meta(
+		path: str
+) -> Optional[Dict[str, Any]]:
+	"""
+	Returns the metadata of features saved with save_features, or None if there are none.
+	"""
+	meta_path = os.path.join(path, "meta.json")
+	if not os.path.exists(meta_path):
+		return None
+	with open(meta_path, "r") as f:
+		return json.load(f)
+
+def load_features(
+		path: str
+) -> List[List[List[str]]]:
+	"""
+	Load the feature sequences saved with save_features.
+	"""
+	with open(os.path.join(path, "vocab.json"), "r") as f:
+		vocab = json.load(f)
+	features = [vocab[i] for i in np.load(os.path.join(path, "feature_ids.npy")).tolist()]
+	item_offsets = np.load(os.path.join(path, "item_offsets.npy")).tolist()
+	seq_offsets = np.load(os.path.join(path, "seq_offsets.npy")).tolist()
+	items = [features[start:end] for start, end in zip(item_offsets[:-1], item_offsets[1:])]
+	return [items[start:end] for start, end in zip(seq_offsets[:-1], seq_offsets[1:])]
+
+def precompute_features(
+		sents: List[Tuple[List[str], List[str]]],
+		path: str,
+		extractor: FeatureExtractor,
+		verbose: bool = False
+) -> List[List[List[str]]]:
+	"""
+	Returns the features of a corpus of (words, pos) pairs, loading them from path if they
+	were saved with the same extractor parameters and corpus, otherwise computing and
+	saving them. This lets hyperparameter trials with the same feature parameters share them.
+	"""
+	meta = {"params": extractor.params(), "corpus": corpus_hash(sents)}
+	if load_features_meta(path) == meta:
+		if verbose: print(f"Loading features from {path}")
+		return load_features(path)
+	features = extractor.corpus_features(sents, verbose)
+	save_features(features, path, meta)
+	return features
+
+def labels_to_results(
+		doc_tokens: List[Dict[str, Any]],
+		doc_labels: List[List[str]]
+) -> List[Dict[str, Any]]:
+	"""
+	Converts the BIO labels of the sentences of a document to Label Studio results,
+	merging consecutive tokens with the same tag into a span.
+	"""
+	doc_results = []
+	for s, sent_labels in enumerate(doc_labels):
+		tag = None
+		for i, label in enumerate(sent_labels):
+			if LABEL_TAGS.get(label, ".") != tag:
+				if tag is not None:
+					doc_results.append({
+						"value": {
+							"start": int(start),
+							"end": int(end),
+							"labels": [tag]
+						}
+					})
+				start = None
+				end = None
+				tag = None
+			if label == "O":
+				continue
+			if start is None:
+				start, end = doc_tokens[s]["spans"][i]
+				tag = LABEL_TAGS[label]
+			else:
+				end = doc_tokens[s]["spans"][i][1]
+		if tag is not None:
+			doc_results.append({
+				"value": {
+					"start": int(start),
+					"end": int(end),
+					"labels": [tag]
+				}
+			})
+	return doc_results
+
+def tag_doc(
+		doc_tokens: List[Dict[str, Any]],
+		doc_pos: List[List[str]],
+		tagger: crfs.Tagger,
+		extractor: FeatureExtractor
+) -> List[Dict[str, Any]]:
+	"""
+	Tags the sentences of a document and returns its Label Studio results.
+	"""
+	doc_labels = [tagger.tag(extractor.sent_features(sentence["tokens"], sent_pos))\
+		for sentence, sent_pos in zip(doc_tokens, doc_pos)]
+	return labels_to_results(doc_tokens, doc_labels)
+
+def _init_tagger(
+		model_path: str,
+		extractor_params: Dict[str, Any]
+) -> Tuple[crfs.Tagger, FeatureExtractor]:
+	"""
+	Context of a parallel worker: the model is opened once per worker.
+	"""
+	tagger = crfs.Tagger()
+	tagger.open(model_path)
+	return tagger, FeatureExtractor(**extractor_params)
+
+def _tag_doc_worker(
+		doc: Tuple[List[Dict[str, Any]], List[List[str]]],
+		context: Tuple[crfs.Tagger, FeatureExtractor]
+) -> List[Dict[str, Any]]:
+	"""
+	Tags a (tokens, pos) document in a parallel worker.
+	"""
+	tagger, extractor = context
+	return tag_doc(*doc, tagger, extractor)
+
+class _EarlyStop(Exception):
+	pass
+
+class LoggingTrainer(crfs.Trainer):
+	def __init__(
+			self,
+			metric: str = "avg_f1",
+			patience: Optional[int] = None,
+			min_delta: float = 1e-4,
+			min_iterations: int = 0
+	):
+		"""
+		Trainer that records the loss, time and holdout scores of every iteration, and stops
+		the training once the holdout metric has not improved by more than min_delta for
+		patience iterations (if patience is given), never before min_iterations.
+		"""
+		super(LoggingTrainer, self).__init__(verbose=False)
+		self.metric = metric
+		self.patience = patience
+		self.min_delta = min_delta
+		self.min_iterations = min_iterations
+		self.iterations = []
+		self.best = None
+		self.stopped = False
+
+	def message(
+			self,
+			message: str
+	) -> None:
+		"""
+		Parses the training log, the callbacks of crfs.Trainer are only called when verbose.
+		"""
+		if self.logparser.feed(message) != "iteration":
+			return
+		info = self.logparser.last_iteration
+		self.iterations.append({
+			"num": info["num"],
+			"loss": info["loss"],
+			"time": info["time"],
+			"active_features": info.get("active_features"),
+			self.metric: info.get(self.metric)
+		})
+		score = info.get(self.metric)
+		if score is None:
+			return
+		if self.best is None or score > self.best[self.metric] + self.min_delta:
+			self.best = self.iterations[-1]
+		elif self.patience is not None and info["num"] >= self.min_iterations and\
+			info["num"] - self.best["num"] >= self.patience:
+			self.stopped = True
+			raise _EarlyStop()
+
+def train_with_early_stopping(
+		X_train: List[List[List[str]]],
+		y_train: List[List[str]],
+		model_path: str,
+		trainer_params: Dict[str, Any],
+		holdout: float = 0.1,
+		patience: int = 10,
+		min_delta: float = 1e-4,
+		min_iterations: int = 20,
+		metric: str = "avg_f1",
+		refit: bool = True,
+		seed: int = 0,
+		verbose: bool = False
+) -> Dict[str, Any]:
+	"""
+	Trains a CRF in two phases:
+	1. A fraction holdout of the sequences is held out (pycrfsuite holdout group) and the
+		training stops when the holdout metric (e.g. "avg_f1", "item_accuracy_float")
+		plateaus for patience iterations, after at least min_iterations (the first iterations
+		usually predict only "O"). The iteration with the best score is chosen.
+	2. The model is trained up to the chosen iteration, on all the sequences if refit,
+		otherwise without the holdout ones, and saved to model_path.
+	The iteration timings, scores and the stopping point are saved to model_path + ".schedule.json".
+		Returns the schedule.
+	"""
+	n_holdout = max(1, round(len(X_train) * holdout))
+	holdout_idx = set(random.Random(seed).sample(range(len(X_train)), n_holdout))
+	# phase 1: find the stopping point on the holdout sequences
+	start = time()
+	trainer = LoggingTrainer(metric, patience, min_delta, min_iterations)
+	for i, (xseq, yseq) in enumerate(zip(X_train, y_train)):
+		trainer.append(xseq, yseq, int(i in holdout_idx))
+	trainer.set_params(trainer_params)
+	try:
+		trainer.train("", holdout=1) # no model is written
+	except _EarlyStop:
+		pass
+	holdout_time = time() - start
+	if trainer.best is None:
+		raise ValueError(f"Holdout metric {metric} not found in the training log")
+	best_iteration = trainer.best["num"]
+	if verbose: print(f"Stopping point: iteration {best_iteration} ({metric}={trainer.best[metric]})")
+	# phase 2: train the final model up to the stopping point
+	start = time()
+	final_trainer = LoggingTrainer(metric)
+	for i, (xseq, yseq) in enumerate(zip(X_train, y_train)):
+		if refit or i not in holdout_idx:
+			final_trainer.append(xseq, yseq)
+	final_trainer.set_params({**trainer_params, "max_iterations": best_iteration})
+	final_trainer.train(model_path)
+	schedule = {
+		"trainer_params": trainer_params,
+		"metric": metric,
+		"holdout_sequences": n_holdout,
+		"patience": patience,
+		"min_delta": min_delta,
+		"min_iterations": min_iterations,
+		"refit": refit,
+		"stopped_early": trainer.stopped,
+		"best_iteration": best_iteration,
+		"best_score": trainer.best[metric],
+		"holdout_time": round(holdout_time, 4),
+		"final_time": round(time() - start, 4),
+		"holdout_iterations": trainer.iterations,
+		"final_iterations": final_trainer.iterations
+	}
+	with open(model_path + ".schedule.json", "w") as f:
+		json.dump(schedule, f, indent=4)
+	return schedule
+
+def load_training_sents(
+		train_tokens_path: str,
+		train_labels_path: str,
+		train_pos_path: Optional[str] = None,
+		nlps: Optional[Tuple[Any, Any]] = None,
+		verbose: bool = False
+) -> Tuple[List[Tuple[List[str], List[str]]], List[List[str]]]:
+	"""
+	Loads the training tokens, labels and POS tags (computed with nlps if train_pos_path is
+	not given). Each document is a single sequence.
+		Returns the (words, pos) pairs and the labels of every document.
+	"""
+	train_data = load_tokens(train_tokens_path)
+	with open(train_labels_path, "r") as f:
+		train_labels = json.load(f)
+	if train_pos_path is not None:
+		with open(train_pos_path, "r") as f:
+			train_pos = json.load(f)
+	else:
+		train_pos = compute_pos(train_data, nlps, verbose)
+	sents_pos, labels = [], []
+	for doc_tokens, doc_labels, doc_pos in tqdm(zip(train_data, train_labels, train_pos),\
+											 total=len(train_data), disable=not verbose):
+		words, pos, doc_y = [], [], []
+		for sentence, sent_labels, sent_pos in zip(doc_tokens, doc_labels, doc_pos):
+			# zip truncates to the shortest, as when building (token, pos, label) triples
+			for token, p, label in zip(sentence["tokens"], sent_pos, sent_labels):
+				words.append(token)
+				pos.append(p)
+				doc_y.append(label)
+		sents_pos.append((words, pos))
+		labels.append(doc_y)
+	return sents_pos, labels
+
+def split_params(
+		params: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+	"""
+	Splits CRF parameters into the feature parameters (with their defaults) and the
+	trainer parameters. Evaluation options (EVAL_PARAMS) are dropped.
+	"""
+	feature_params = FeatureExtractor().params()
+	feature_params.update({k: v for k, v in params.items() if k in FEATURE_PARAMS})
+	trainer_params = {k: v for k, v in params.items() if k not in FEATURE_PARAMS and k not in EVAL_PARAMS}
+	return feature_params, trainer_params
+
+def _init_search_worker(
+		train_labels: List[List[str]],
+		eval_tokens: List[List[Dict[str, Any]]],
+		eval_pos: List[List[List[str]]]
+) -> Dict[str, Any]:
+	"""
+	Context of a search worker: the labels and evaluation data are shipped once per worker.
+	"""
+	return {"labels": train_labels, "eval_tokens": eval_tokens, "eval_pos": eval_pos, "features": {}}
+
+def _run_trial(
+		trial: Tuple[str, Dict[str, Any], Dict[str, Any], str],
+		context: Dict[str, Any]
+) -> Dict[str, Any]:
+	"""
+	Trains a model on precomputed features and tags the evaluation data with it.
+	Trials are sorted by features, so a worker only keeps the last features it loaded.
+	"""
+	features_path, feature_params, trainer_params, model_path = trial
+	if features_path not in context["features"]:
+		context["features"].clear()
+		context["features"][features_path] = load_features(features_path)
+	X_train = context["features"][features_path]
+	trainer_params = dict(trainer_params)
+	early_stopping = trainer_params.pop("early_stopping", None)
+	start = time()
+	schedule = None
+	if early_stopping not in (None, False):
+		schedule = train_with_early_stopping(X_train, context["labels"], model_path, trainer_params,\
+									   **(early_stopping if isinstance(early_stopping, dict) else {}))
+	else:
+		trainer = crfs.Trainer(verbose=False)
+		for xseq, yseq in zip(X_train, context["labels"]):
+			trainer.append(xseq, yseq)
+		trainer.set_params(trainer_params)
+		trainer.train(model_path)
+	train_time = time() - start
+	start = time()
+	tagger = crfs.Tagger()
+	tagger.open(model_path)
+	extractor = FeatureExtractor(**feature_params)
+	results = [tag_doc(doc_tokens, doc_pos, tagger, extractor)\
+		for doc_tokens, doc_pos in zip(context["eval_tokens"], context["eval_pos"])]
+	tagger.close()
+	return {"results": results, "model_path": model_path, "train_time": train_time, "predict_time": time() - start,\
+		"schedule": schedule}
+
+def search(
+		params_list: List[Dict[str, Any]],
+		train_tokens_path: str,
+		train_labels_path: str,
+		train_pos_path: str,
+		eval_tokens_path: str,
+		eval_pos_path: str,
+		save_dir: str,
+		n_workers: Optional[int] = 1,
+		verbose: bool = False
+) -> List[Dict[str, Any]]:
+	"""
+	Trains and applies a CRF for each parameter combination of a hyperparameter search.
+	The training data is loaded once and the training features are built once per set of
+	feature parameters (FEATURE_PARAMS) in save_dir/features, then shared by all the trials
+	that only differ in trainer parameters (c1, c2, max_iterations...).
+	Parameters:
+	- params_list: CRF parameters of each trial (see CRF).
+	- save_dir: directory for the features and the models (save_dir/search/crf_<i>.crfsuite).
+	- n_workers: number of processes running trials, None for all the CPUs.
+
+	Returns, for each trial, the Label Studio results of every evaluation document,
+	the model path, the training and prediction times and the early stopping schedule, if any.
+	"""
+	sents_pos, train_labels = load_training_sents(train_tokens_path, train_labels_path, train_pos_path)
+	eval_tokens = load_tokens(eval_tokens_path)
+	with open(eval_pos_path, "r") as f:
+		eval_pos = json.load(f)
+	models_dir = os.path.join(save_dir, "search")
+	if not os.path.exists(models_dir):
+		os.makedirs(models_dir)
+	trials = []
+	for i, params in enumerate(params_list):
+		feature_params, trainer_params = split_params(params)
+		extractor = FeatureExtractor(**feature_params)
+		features_path = os.path.join(save_dir, "features", "train_" + extractor.key())
+		if not any(trial[0] == features_path for trial in trials):
+			if verbose: print(f"Building features {feature_params}...")
+			precompute_features(sents_pos, features_path, extractor, verbose)
+		trials.append((features_path, feature_params, trainer_params, os.path.join(models_dir, f"crf_{i}.crfsuite")))
+	# run trials grouped by features, results are returned in the original order
+	order = sorted(range(len(trials)), key=lambda i: trials[i][0])
+	init_args = (train_labels, eval_tokens, eval_pos)
+	if n_workers != 1:
+		outputs, _ = parallel_map(_run_trial, [trials[i] for i in order], _init_search_worker, init_args,\
+							n_workers=n_workers, chunk_size=1, verbose=verbose)
+	else:
+		context = _init_search_worker(*init_args)
+		outputs = [_run_trial(trials[i], context) for i in tqdm(order, disable=not verbose)]
+	results = [None] * len(trials)
+	for i, output in zip(order, outputs):
+		results[i] = output
+	return results
+
 class CRF:
 
 	def __init__(
@@ -84,20 +678,26 @@ class CRF:
 	):
 		self.model_path = model_path
 		if nlps is None:
-			nlps = load_nlps()
+			nlps = load_nlps("tagger")
+		# shared models, NER and parser (if loaded) are skipped with run_pipes instead of disabled
 		self.nlp_es, self.nlp_ca = nlps
-		# Disable NER and parser for faster processing
-		self.nlp_es.disable_pipes('ner', 'parser')
-		self.nlp_ca.disable_pipes('ner', 'parser')
 
 		# Set trainer parameters
-		other_params = ["padding", "before_lim", "after_lim", "special_words"]
+		other_params = ["padding", "before_lim", "after_lim", "special_words", "early_stopping"]
 		self.padding = trainer_params.get("padding", False)
 		self.before_lim = trainer_params.get("before_lim", 6)
 		self.after_lim = trainer_params.get("after_lim", 1)
-		self.special_words = trainer_params.get("special_words",\
-			["nada", "ni", "nunca", "ningun", "ninguno", "ninguna", "alguna", "apenas", "para_nada", "ni_siquiera"])
+		self.special_words = trainer_params.get("special_words", DEFAULT_SPECIAL_WORDS)
+		self.extractor = FeatureExtractor(self.padding, self.before_lim, self.after_lim, self.special_words)
+		# True or a dict of train_with_early_stopping options to train with a holdout schedule
+		self.early_stopping = trainer_params.get("early_stopping", None)
+		if self.early_stopping is True:
+			self.early_stopping = {}
+		elif self.early_stopping is False:
+			self.early_stopping = None
+		self.schedule = None
 		trainer_params = {k:v for k,v in trainer_params.items() if k not in other_params}
+		self.trainer_params = trainer_params
 		self.verbose = verbose
 
 		# Load model if it exists, otherwise create a new one
@@ -124,78 +724,9 @@ class CRF:
 		"""
 		Returns a list of features for a given word in a sentence.
 		"""
-		word, pos, _ = sent[idx]
-		features = [
-			"bias",
-			"word=" + word,
-			"pos=" + pos,
-			"is_first_capital=" + str(word[0].isupper()),
-			"is_alphanumeric=" + str(word.isalnum()),
-			"has_num=" + str(any(char.isdigit() for char in word)),
-			"has_cap=" + str(any(char.isupper() for char in word)),
-			"has_dash=" + str('-' in word),
-			"has_us=" + str('_' in word),
-			"has_punctuation=" + str(any(char in string.punctuation for char in word)),
-			"is_special=" + str(word.lower() in self.special_words)
-		]
-
-		# Adding suffix features for suffix lengths of 2, 3, and 4
-		suffix_lengths = [2, 3, 4]
-		for length in suffix_lengths:
-			if len(word) >= length:
-				features.append(f"suffix-{length}=" + word[-length:])
-
-		# Adding prefix features for prefix lengths of 2, 3, and 4
-		prefix_lengths = [2, 3, 4]
-		for length in prefix_lengths:
-			if len(word) >= length:
-				features.append(f"prefix-{length}=" + word[:length])
-
-		pad_token = "<PAD>"
-		if self.padding:
-			# Ensure there are always self.before_lim bigram features, use padding if necessary
-			for j in range(1, self.before_lim + 1):  # Generate bigrams up to self.before_lim
-				if idx >= j:
-					prev_word = sent[idx - j][0]
-				else:
-					prev_word = pad_token  # Use padding token if there are not enough previous words
-				current_bigram = f"2GRAMBEFORE_{j}={prev_word}_{word}"
-				features.append(current_bigram)
-
-		else:
-			# Adding bigram features for up to self.before_lim words before the current word
-			for j in range(max(0, idx-self.before_lim), idx):
-				if idx > 0 and j < idx:  # Check to ensure there is a previous word to form a bigram
-					prev_word = sent[j][0]
-					current_bigram = f"2GRAMBEFORE={prev_word}_{word}"
-					features.append(current_bigram)
-
-		# Add bigram features for up to self.after_lim words after the current word
-		for j in range(1, self.after_lim + 1):
-			if idx + j < len(sent):
-				next_word = sent[idx + j][0]
-				current_bigram_after = f"2GRAMAFTER_{j}={word}_{next_word}"
-				features.append(current_bigram_after)
-			elif self.padding:
-				next_word = pad_token  # Use padding token if there is no next word
-				current_bigram_after = f"2GRAMAFTER_{j}={word}_{next_word}"
-				features.append(current_bigram_after)
-
-		# beforepos
-		for i in range(1, self.before_lim + 1):
-			if idx - i >= 0:
-				features.append(f'BEFOREPOS-{i}=' + sent[idx - i][0])
-			elif self.padding:
-				features.append(f'BEFOREPOS-{i}=START')
-		
-		# afterpos
-		for i in range(1, self.after_lim + 1):
-			if idx + i < len(sent):
-				features.append(f'AFTERPOS-{i}=' + sent[idx + i][0])
-			elif self.padding:
-				features.append(f'AFTERPOS-{i}=END')
-		
-		return features
+		words = [str(word) for word, _, _ in sent]
+		pos = [p for _, p, _ in sent]
+		return self.extractor.features(words, pos, idx)
 
 	def sent2features(
 			self,
@@ -204,7 +735,7 @@ class CRF:
 		"""
 		Returns a list of features for each word in a sentence.
 		"""
-		return [self.word2features(sent, i) for i in range(len(sent))]
+		return self.extractor.sent_features([word for word, _, _ in sent], [p for _, p, _ in sent])
 
 	def sent2labels(
 			self,
@@ -228,50 +759,36 @@ class CRF:
 			self,
 			train_tokens_path: str,
 			train_labels_path: str,
-			train_pos_path: Optional[str] = None
+			train_pos_path: Optional[str] = None,
+			features_path: Optional[str] = None
 	) -> None:
 		"""
 		Trains the CRF model on the given training data.
+		If features_path is given, the training features are saved there and reused by later
+		trainings with the same data and feature parameters (see precompute_features).
 		"""
 		if self.trainer is None:
 			raise ValueError("Model already trained")
 		
-		# Load raw training data
-		train_data = load_tokens(train_tokens_path)
-		with open(train_labels_path, "r") as f:
-			train_labels = json.load(f)
-		if train_pos_path is not None:
-			with open(train_pos_path, "r") as f:
-				train_pos = json.load(f)
-
-		# Process input data into words, POS tags, and labels
-		sents = []
-		for d, (doc_tokens, doc_labels) in tqdm(enumerate(zip(train_data, train_labels)),\
-										  total=len(train_data), disable=not self.verbose):
-			sent = []
-			for s, (sentence, labels) in enumerate(zip(doc_tokens, doc_labels)):
-				if train_pos_path is not None:
-					pos = train_pos[d][s]
-				else:
-					lang = sentence["lang"]
-					if lang == "ca":
-						doc = self.nlp_ca(" ".join(sentence["tokens"]))
-					else:
-						doc = self.nlp_es(" ".join(sentence["tokens"]))
-					pos = [token.pos_ for token in doc]
-				sent.extend(list(zip(sentence["tokens"], pos, labels)))
-			sents.append(sent)
-
-		# Create input features and target labels
-		X_train = [self.sent2features(sent) for sent in sents]
-		y_train = [self.sent2labels(sent) for sent in sents]
-
-		for xseq, yseq in zip(X_train, y_train):
-			self.trainer.append(xseq, yseq)
+		# Load words, POS tags, and labels
+		sents_pos, y_train = load_training_sents(train_tokens_path, train_labels_path, train_pos_path,\
+										   (self.nlp_es, self.nlp_ca), self.verbose)
+
+		# Create input features
+		if features_path is not None:
+			X_train = precompute_features(sents_pos, features_path, self.extractor, self.verbose)
+		else:
+			X_train = self.extractor.corpus_features(sents_pos)
 
 		# train and save model
 		if self.verbose: print("Training model...")
-		self.trainer.train(self.model_path)
+		if self.early_stopping is not None:
+			self.schedule = train_with_early_stopping(X_train, y_train, self.model_path, self.trainer_params,\
+											 verbose=self.verbose, **self.early_stopping)
+		else:
+			for xseq, yseq in zip(X_train, y_train):
+				self.trainer.append(xseq, yseq)
+			self.trainer.train(self.model_path)
 		if self.verbose: print("Model trained")
 
 		self.tagger = crfs.Tagger()
@@ -292,10 +809,7 @@ class CRF:
 
 		# POS tagging if not provided
 		if pos is None:
-			if lang == "ca":
-				doc = self.nlp_ca(" ".join(tokens))
-			else:
-				doc = self.nlp_es(" ".join(tokens))
+			doc = run_pipes(self.nlp_ca if lang == "ca" else self.nlp_es, " ".join(tokens))
 			pos = [token.pos_ for token in doc]
 		sent = [(token, p, "") for token,p in zip(tokens, pos)]
 		# Get features and predict labels
@@ -309,11 +823,21 @@ class CRF:
 			data_path: str,
 			tokens_path: str,
 			save_path: str,
-			pos_path: Optional[str] = None
+			pos_path: Optional[str] = None,
+			n_workers: Optional[int] = 1,
+			chunk_size: int = 16
 	) -> None:
 		"""
 		Processes the given data and saves the results to a file.
+		If n_workers is not 1, documents are tagged in chunks of chunk_size over a pool of
+		n_workers processes (None for all the CPUs), each opening the model once.
+		Each worker extracts the features of a document and tags it: pycrfsuite holds the GIL
+		while tagging, so the two can not overlap within a process, and extracting in the
+		parent would cost more to send the features to the workers (pickling them takes as
+		long as extracting them) than it saves.
 		"""
+		if self.tagger is None:
+			raise ValueError("Model not trained")
 		with open(data_path, "r") as f:
 			data = json.load(f)
 		data_tokens = load_tokens(tokens_path)
@@ -326,63 +850,18 @@ class CRF:
 		if not os.path.exists(save_dir):
 			os.makedirs(save_dir)
 
-		# Predict labels
-		preds = []
-		for d, doc_tokens in tqdm(enumerate(data_tokens), total=len(data_tokens), disable=not self.verbose):
-			doc_results = []
-			for i, sentence in enumerate(doc_tokens):
-				tokens = sentence["tokens"]
-				if pos is not None:
-					sent_pos = pos[d][i]
-				else:
-					sent_pos = None
-				lang = sentence["lang"]
-				labels = self.predict(tokens, sent_pos, lang)
-				doc_results.append(labels)
-			preds.append(doc_results)
-
-		# Save preds to formated predictions
-		tags = {"B-NEG": "NEG", "I-NEG": "NEG", "B-NSCO": "NSCO", "I-NSCO": "NSCO",\
-		  		"B-UNC": "UNC", "I-UNC": "UNC", "B-USCO": "USCO", "I-USCO": "USCO"}
-		predictions = []
-		for d, doc_preds in enumerate(preds):
-			doc_results = []
-			for s, sent_preds in enumerate(doc_preds):
-				tag = None
-				for i, label in enumerate(sent_preds):
-					if tags.get(label, ".") != tag:
-						if tag is not None:
-							doc_results.append({
-								"value": {
-									"start": int(start),
-									"end": int(end),
-									"labels": [tag]
-								}
-							})
-						start = None
-						end = None
-						tag = None
-					if label == "O":
-						continue
-					if start is None:
-						start, end = data_tokens[d][s]["spans"][i]
-						tag = tags[label]
-					else:
-						end = data_tokens[d][s]["spans"][i][1]
-				if tag is not None:
-					doc_results.append({
-						"value": {
-							"start": int(start),
-							"end": int(end),
-							"labels": [tag]
-						}
-					})
-			predictions.append([
-				{
-					"result": doc_results
-				}
-			])
-		
+		# Predict labels and convert them to Label Studio results
+		if pos is None:
+			pos = compute_pos(data_tokens, (self.nlp_es, self.nlp_ca), self.verbose)
+		if n_workers != 1:
+			init_args = (self.model_path, self.extractor.params())
+			results, _ = parallel_map(_tag_doc_worker, list(zip(data_tokens, pos)), _init_tagger, init_args,\
+								n_workers=n_workers, chunk_size=chunk_size, verbose=self.verbose)
+		else:
+			results = [tag_doc(doc_tokens, doc_pos, self.tagger, self.extractor)\
+				for doc_tokens, doc_pos in tqdm(zip(data_tokens, pos), total=len(data_tokens), disable=not self.verbose)]
+		predictions = [[{"result": doc_results}] for doc_results in results]
+
 		for d in range(len(data)):
 			data[d]["predictions"] = predictions[d]
 
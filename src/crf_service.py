@@ -0,0 +1,389 @@
+import json
+import os
+import sys
+import threading
+import queue
+import urllib.request
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from crf import CRF, compute_pos, tag_doc
+from preprocessing import TokenNormalizer, sent_tokenize_corpus, tokenize_corpus
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+def _percentiles(
+		latencies: List[float]
+) -> Dict[str, Optional[float]]:
+	"""
+	Returns the mean, p50 and p99 of a list of latencies in seconds, in milliseconds.
+	"""
+	if not latencies:
+		return {"mean_ms": None, "p50_ms": None, "p99_ms": None}
+	ms = np.array(latencies) * 1000
+	return {
+		"mean_ms": round(float(ms.mean()), 3),
+		"p50_ms": round(float(np.percentile(ms, 50)), 3),
+		"p99_ms": round(float(np.percentile(ms, 99)), 3)
+	}
+
+def _check_text(
+		text: Any
+) -> None:
+	"""
+	Raises TypeError if text is not a string and ValueError if it is blank.
+	"""
+	if not isinstance(text, str):
+		raise TypeError(f"text must be a string, not {type(text).__name__}")
+	if not text.strip():
+		raise ValueError("text is empty")
+
+class CRFService:
+	def __init__(
+			self,
+			model_path: str,
+			trainer_params: Optional[Dict[str, Any]] = None,
+			nlps: Optional[Tuple[Any, Any]] = None,
+			remove_punctuation: bool = True,
+			replace_numbers: Optional[str] = None,
+			max_batch_size: int = 32,
+			max_wait: float = 0.005,
+			history: int = 10000,
+			verbose: bool = False
+	):
+		"""
+		Long-lived tagging service around a loaded CRF model. Raw texts are sentence split,
+		tokenized and POS tagged with spacy like the training data, then tagged with the model.
+		Concurrent requests are grouped into micro-batches by a background thread.
+		Parameters:
+		- model_path: path of a trained .crfsuite model.
+		- trainer_params: feature parameters the model was trained with (see CRF).
+		- nlps: spacy models for Spanish and Catalan, loaded with a tagger if not given.
+		- remove_punctuation / replace_numbers: token normalization used for the training data.
+		- max_batch_size: maximum number of texts tagged together.
+		- max_wait: maximum time (s) the first request of a batch waits for others.
+		- history: number of latencies kept for the metrics.
+		"""
+		self.model = CRF(model_path, trainer_params or {}, nlps, verbose)
+		if self.model.tagger is None:
+			raise ValueError("Model not trained")
+		self.normalizer = TokenNormalizer(remove_punctuation, True, replace_numbers)
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.verbose = verbose
+		self._requests = queue.Queue()
+		self._lock = threading.Lock()
+		self._latencies = deque(maxlen=history)
+		self._batch_sizes = deque(maxlen=history)
+		self._n_requests = 0
+		self._closed = False
+		self._started = time()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def tag_batch(
+			self,
+			texts: List[str]
+	) -> List[List[Dict[str, Any]]]:
+		"""
+		Tags a list of raw texts.
+			Returns the Label Studio results (NEG, NSCO, UNC and USCO spans) of each text.
+		"""
+		sents = sent_tokenize_corpus([{"data": {"text": text}} for text in texts])
+		nlps = (self.model.nlp_es, self.model.nlp_ca)
+		tokens = tokenize_corpus(sents, *nlps, normalizer=self.normalizer)
+		pos = compute_pos(tokens, nlps)
+		return [tag_doc(doc_tokens, doc_pos, self.model.tagger, self.model.extractor)\
+			for doc_tokens, doc_pos in zip(tokens, pos)]
+
+	def _run(self) -> None:
+		"""
+		Background loop: waits for a request, gathers the ones arriving within max_wait and
+		tags them together.
+		"""
+		while True:
+			item = self._requests.get()
+			if item is None:
+				return
+			batch = [item]
+			deadline = perf_counter() + self.max_wait
+			while len(batch) < self.max_batch_size:
+				timeout = deadline - perf_counter()
+				if timeout <= 0:
+					break
+				try:
+					item = self._requests.get(timeout=timeout)
+				except queue.Empty:
+					break
+				if item is None:
+					self._requests.put(None) # stop after this batch
+					break
+				batch.append(item)
+			try:
+				results = self.tag_batch([text for text, _, _ in batch])
+			except Exception as e:
+				if len(batch) == 1:
+					batch[0][1].set_exception(e)
+					continue
+				# retry one by one so only the failing requests get the error
+				results = []
+				for text, _, _ in batch:
+					try:
+						results.append(self.tag_batch([text])[0])
+					except Exception as e:
+						results.append(e)
+			end = perf_counter()
+			with self._lock:
+				self._batch_sizes.append(len(batch))
+				self._latencies.extend(end - start for _, _, start in batch)
+			for (_, future, _), result in zip(batch, results):
+				if isinstance(result, Exception):
+					future.set_exception(result)
+				else:
+					future.set_result(result)
+
+	def submit(
+			self,
+			text: str
+	) -> Future:
+		"""
+		Queues a text to be tagged.
+			Returns a future with its results.
+		Raises TypeError if the text is not a string, ValueError if it is blank and
+		RuntimeError if the service is closed.
+		"""
+		_check_text(text)
+		future = Future()
+		with self._lock:
+			if self._closed:
+				raise RuntimeError("service is closed")
+			self._n_requests += 1
+			self._requests.put((text, future, perf_counter()))
+		return future
+
+	def tag(
+			self,
+			text: str,
+			timeout: Optional[float] = None
+	) -> List[Dict[str, Any]]:
+		"""
+		Tags a raw text, waiting for its micro-batch.
+			Returns its Label Studio results.
+		"""
+		return self.submit(text).result(timeout)
+
+	def metrics(self) -> Dict[str, Any]:
+		"""
+		Returns the number of requests, the batch sizes and the latency percentiles (queueing
+		included) of the last requests.
+		"""
+		with self._lock:
+			latencies = list(self._latencies)
+			batch_sizes = list(self._batch_sizes)
+			n_requests = self._n_requests
+		return {
+			"requests": n_requests,
+			"batches": len(batch_sizes),
+			"avg_batch_size": round(sum(batch_sizes) / len(batch_sizes), 3) if batch_sizes else None,
+			"uptime": round(time() - self._started, 3),
+			**_percentiles(latencies)
+		}
+
+	def close(self) -> None:
+		"""
+		Stops the background thread once the queued requests are tagged. Later calls to
+		submit raise RuntimeError.
+		"""
+		with self._lock:
+			if not self._closed:
+				self._closed = True
+				self._requests.put(None)
+		self._thread.join()
+
+	def __enter__(self) -> "CRFService":
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+def _make_handler(
+		service: CRFService
+) -> type:
+	class Handler(BaseHTTPRequestHandler):
+		def _send(self, code: int, body: Any) -> None:
+			payload = json.dumps(body).encode("utf-8")
+			self.send_response(code)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(payload)))
+			self.end_headers()
+			self.wfile.write(payload)
+
+		def do_GET(self) -> None:
+			if self.path == "/metrics":
+				self._send(200, service.metrics())
+			else:
+				self._send(404, {"error": "not found"})
+
+		def do_POST(self) -> None:
+			"""
+			POST /tag with {"text": str} or {"texts": [str, ...]}.
+			"""
+			if self.path != "/tag":
+				self._send(404, {"error": "not found"})
+				return
+			try:
+				request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+				if not isinstance(request, dict):
+					raise TypeError("request must be a JSON object")
+				if "texts" in request:
+					if not isinstance(request["texts"], list):
+						raise TypeError("texts must be a list")
+					for text in request["texts"]:
+						_check_text(text)
+					futures = [service.submit(text) for text in request["texts"]]
+					self._send(200, {"results": [future.result() for future in futures]})
+				else:
+					self._send(200, {"result": service.tag(request["text"])})
+			except (ValueError, KeyError, TypeError) as e:
+				self._send(400, {"error": str(e)})
+			except RuntimeError as e:
+				self._send(503, {"error": str(e)})
+			except Exception as e:
+				self._send(500, {"error": str(e)})
+
+		def log_message(self, format: str, *args) -> None:
+			if service.verbose:
+				super().log_message(format, *args)
+	return Handler
+
+def serve_http(
+		service: CRFService,
+		host: str = "127.0.0.1",
+		port: int = 8000
+) -> ThreadingHTTPServer:
+	"""
+	Returns a threaded HTTP server for the service (POST /tag, GET /metrics).
+	Call serve_forever() on it to start serving.
+	"""
+	return ThreadingHTTPServer((host, port), _make_handler(service))
+
+def serve_stdio(
+		service: CRFService,
+		input_stream = sys.stdin,
+		output_stream = sys.stdout
+) -> None:
+	"""
+	Serves JSON lines: each input line {"id": ..., "text": str} is answered, in the same
+	order, with a line {"id": ..., "result": [...]}. Lines read while a batch is being tagged
+	are micro-batched together. {"metrics": true} answers with the service metrics.
+	"""
+	pending = queue.Queue()
+	def write() -> None:
+		while True:
+			item = pending.get()
+			if item is None:
+				return
+			request_id, future = item
+			try:
+				response = {"id": request_id, "result": future.result()}
+			except Exception as e:
+				response = {"id": request_id, "error": str(e)}
+			output_stream.write(json.dumps(response) + "\n")
+			output_stream.flush()
+	writer = threading.Thread(target=write, daemon=True)
+	writer.start()
+	for line in input_stream:
+		if not line.strip():
+			continue
+		request_id = None
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise TypeError("request must be a JSON object")
+			request_id = request.get("id")
+			if request.get("metrics"):
+				future = Future()
+				future.set_result(service.metrics())
+			else:
+				future = service.submit(request.get("text"))
+		except (ValueError, TypeError, RuntimeError) as e:
+			# bad lines are answered with an error, the server keeps reading
+			future = Future()
+			future.set_exception(e)
+		pending.put((request_id, future))
+	pending.put(None)
+	writer.join()
+
+def load_test(
+		url: str,
+		texts: List[str],
+		n_requests: int = 200,
+		concurrency: int = 8,
+		timeout: float = 60.0
+) -> Dict[str, Any]:
+	"""
+	Sends n_requests single-text requests (cycling over texts) to a running HTTP service
+	from concurrency threads.
+		Returns the client-side throughput, errors and latency percentiles, and the
+		server metrics.
+	"""
+	url = url.rstrip("/")
+	def request(i: int) -> Tuple[float, bool]:
+		payload = json.dumps({"text": texts[i % len(texts)]}).encode("utf-8")
+		req = urllib.request.Request(url + "/tag", data=payload, headers={"Content-Type": "application/json"})
+		start = perf_counter()
+		try:
+			with urllib.request.urlopen(req, timeout=timeout) as response:
+				response.read()
+			return perf_counter() - start, True
+		except Exception:
+			return perf_counter() - start, False
+	start = perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		results = list(executor.map(request, range(n_requests)))
+	elapsed = perf_counter() - start
+	with urllib.request.urlopen(url + "/metrics", timeout=timeout) as response:
+		server = json.load(response)
+	return {
+		"requests": n_requests,
+		"concurrency": concurrency,
+		"errors": sum(not ok for _, ok in results),
+		"throughput": round(n_requests / elapsed, 3),
+		**_percentiles([latency for latency, ok in results if ok]),
+		"server": server
+	}
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="CRF negation and uncertainty tagging service")
+	parser.add_argument("mode", choices=["http", "stdio", "load-test"])
+	parser.add_argument("--model", default=os.path.join(DATA_DIR, "bio_crf.crfsuite"))
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--max-batch-size", type=int, default=32)
+	parser.add_argument("--max-wait", type=float, default=0.005)
+	parser.add_argument("--url", default="http://127.0.0.1:8000")
+	parser.add_argument("--data", default=os.path.join(DATA_DIR, "test_data.json"))
+	parser.add_argument("--requests", type=int, default=200)
+	parser.add_argument("--concurrency", type=int, default=8)
+	args = parser.parse_args()
+	if args.mode == "load-test":
+		with open(args.data, "r", encoding="utf8") as f:
+			texts = [d["data"]["text"] for d in json.load(f)]
+		print(json.dumps(load_test(args.url, texts, args.requests, args.concurrency), indent=4))
+	else:
+		service = CRFService(args.model, max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+		if args.mode == "http":
+			server = serve_http(service, args.host, args.port)
+			print(f"Serving on http://{args.host}:{server.server_port}", file=sys.stderr)
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+			server.server_close()
+		else:
+			serve_stdio(service)
+		service.close()
@@ -2,6 +2,7 @@ from preprocessing import *
 import blindNegex
 import os
 import deprecated.cutext as cutext
+from terms import TermExtractor
 
 ROOT_DIR = os.path.dirname(os.path.abspath(""))
 
@@ -24,8 +25,11 @@ def read_terms_txt(
 
 def get_medical_terms(
 		tokens: np.ndarray,
-		cutext_path: Optional[str] = None
+		cutext_path: Optional[str] = None,
+		extractor: Optional[TermExtractor] = None
 ) -> List[List[str]]:
+	if extractor is not None:
+		return extractor.get_medical_terms(tokens)
 	write_tokens_txt(tokens, os.path.join(ROOT_DIR, "temp", "cutext_in.txt"))
 	cutext.process_input(cutext_path)
 	terms = read_terms_txt(os.path.join(ROOT_DIR, "temp", "hsimpli.txt"))
@@ -136,12 +140,13 @@ def save_spans(
 def process_sent(
 		sent: Dict,
 		cutext_path: Optional[str] = None,
-		negation_speculation_path: Optional[str] = None
+		negation_speculation_path: Optional[str] = None,
+		extractor: Optional[TermExtractor] = None
 ) -> List[Dict]:
 	if not negation_speculation_path:
 		negation_speculation_path = os.path.join(ROOT_DIR, "data", "negation_speculation_word.txt")
 	try:
-		terms = get_medical_terms(sent["tokens"], cutext_path)
+		terms = get_medical_terms(sent["tokens"], cutext_path, extractor)
 		negation_words, negation_dirs, speculation_words, speculation_dirs = \
 			prepare_negation_speculation(negation_speculation_path)
 		neg_idx, neg_dir, unc_idx, unc_dir, terms_idx, terms_bin = \
@@ -157,28 +162,35 @@ def process_sent(
 def process_doc(
 		doc: List[Dict],
 		cutext_path: Optional[str] = None,
-		negation_speculation_path: Optional[str] = None
+		negation_speculation_path: Optional[str] = None,
+		extractor: Optional[TermExtractor] = None
 ) -> List[Dict]:
 	all_spans = []
 	for sent in doc:
 		spans = process_sent(
 			sent,
 			cutext_path=cutext_path,
-			negation_speculation_path=negation_speculation_path)
+			negation_speculation_path=negation_speculation_path,
+			extractor=extractor)
 		all_spans.extend(spans)
 	return {"result": all_spans}
 
 def process_data(
 		data: List[List[Dict]],
 		cutext_path: Optional[str] = None,
-		negation_speculation_path: Optional[str] = None
+		negation_speculation_path: Optional[str] = None,
+		use_cutext: bool = False,
+		terms_path: Optional[str] = None
 ) -> List[Dict]:
+	# medical terms are extracted in-process from the lexicon at terms_path, unless use_cutext
+	extractor = None if use_cutext else TermExtractor(terms_path)
 	predictions = []
 	for doc in tqdm(data):
 		spans = process_doc(
 			doc,
 			cutext_path=cutext_path,
-			negation_speculation_path=negation_speculation_path)
+			negation_speculation_path=negation_speculation_path,
+			extractor=extractor)
 		predictions.append(spans)
 	return predictions
 
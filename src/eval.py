@@ -3,8 +3,12 @@ import os
 from sklearn.metrics import precision_score, recall_score, f1_score
 from preprocessing import *
 import negex, crf, lstm
+import registry
+from cache import PreprocessingCache
 from time import time
+from typing import Callable
 import random
+import itertools
 import fasttext
 import torch
 
@@ -89,6 +93,10 @@ class EvalModel(EvalOfficial):
 	):
 		"""
 		Abstract class for evaluation models.
+		Preprocessing artifacts are cached per document in save_dir/cache unless use_cache is
+		passed as False, and files requested with load_existing_* are only reused if they were
+		built from the same data and options. Files without manifest are rebuilt unless
+		trust_legacy is passed as True.
 		"""
 		super(EvalModel, self).__init__()
 		self.verbose = kwargs.get("verbose", False)
@@ -96,8 +104,19 @@ class EvalModel(EvalOfficial):
 		self.results_dir = results_dir
 		self.data_path = data_path
 		self.data = self.load_data(self.data_path)
+		self.cache = None
+		if kwargs.get("use_cache", True):
+			self.cache = PreprocessingCache(os.path.join(self.save_dir, "cache"),\
+								   trust_legacy=kwargs.get("trust_legacy", False), verbose=self.verbose)
+		self.token_options = {
+			"lemmatize": kwargs.get("lemmatize", False),
+			"remove_punctuation": kwargs.get("remove_punctuation", True),
+			"replace_numbers": kwargs.get("replace_numbers", None)
+		}
 
-		if not load_existing_tokens:
+		# with fused preprocessing, tokens are created along with POS tags and lemmas (see EnhancedEvalModel)
+		if not kwargs.get("fused_preprocessing", False) and\
+			not self.reuse(load_existing_tokens, "data_tokens.json", self.data, "tokens", self.token_options):
 			# Tokenize evaluation data and save tokens
 			if self.verbose: print("Creating evaluation tokens...")
 			self.create_tokens(
@@ -105,7 +124,8 @@ class EvalModel(EvalOfficial):
 				file_name="data_tokens.json",
 				lemmatize=kwargs.get("lemmatize", False),
 				remove_punctuation=kwargs.get("remove_punctuation", True),
-				replace_numbers=kwargs.get("replace_numbers", None)
+				replace_numbers=kwargs.get("replace_numbers", None),
+				n_process=kwargs.get("n_process", 1)
 			)
 		self.name = "Default"
 
@@ -116,6 +136,34 @@ class EvalModel(EvalOfficial):
 		with open(data_path, 'r', encoding='utf8') as _f:
 			data = json.load(_f)
 		return data
+
+	def reuse(
+			self,
+			load_existing: bool,
+			file_name: str,
+			data: List[dict],
+			kind: str,
+			options: dict
+	) -> bool:
+		"""
+		Whether an existing preprocessing file can be reused: it has been requested and,
+		if caching is enabled, it was built from the same data and options. Files without
+		manifest can not be checked: they are rebuilt (with a manifest), or reused with a
+		warning if trust_legacy was passed.
+		"""
+		if not load_existing:
+			return False
+		if self.cache is None:
+			return True
+		path = os.path.join(self.save_dir, file_name)
+		legacy = os.path.exists(path) and not self.cache.has_manifest(path)
+		if self.cache.is_fresh(path, data, kind, options):
+			if legacy:
+				print(f"Warning: {file_name} has no manifest, reusing it without checking it is up to date")
+			return True
+		if self.verbose:
+			print(f"{file_name} has no manifest, recomputing it" if legacy else f"{file_name} is outdated, recomputing it")
+		return False
 	
 	def create_tokens(
 			self,
@@ -123,28 +171,127 @@ class EvalModel(EvalOfficial):
 			file_name: str,
 			lemmatize: bool = False,
 			remove_punctuation: bool = True,
-			replace_numbers: Optional[str] = None
+			replace_numbers: Optional[str] = None,
+			n_process: int = 1
 	) -> List[dict]:
 		"""
-		Tokenize the data and save the tokens.
-		"""
-		# tokenize to sentences
-		sents = sent_tokenize_corpus(data, verbose=self.verbose)
-		nlp_es, nlp_cat = load_nlps()
-		# tokenize to words
-		tokens = tokenize_corpus(
-			sents, nlp_es, nlp_cat,
-			remove_punctuation=remove_punctuation,
-			replace_numbers=replace_numbers,
-			verbose=self.verbose
-		)
-		if lemmatize:
-			# lemmatize tokens
-			tokens = lemmatize_corpus(tokens, nlp_es, nlp_cat, verbose=self.verbose)
+		Tokenize the data and save the tokens. Only the documents missing in the cache are tokenized.
+		"""
+		def compute(idxs: List[int]) -> List[List[dict]]:
+			# tokenize to sentences
+			sents = sent_tokenize_corpus([data[i] for i in idxs], verbose=self.verbose)
+			nlp_es, nlp_cat = load_nlps("lemmatizer" if lemmatize else "tokenizer")
+			# tokenize to words
+			tokens = tokenize_corpus(
+				sents, nlp_es, nlp_cat,
+				remove_punctuation=remove_punctuation,
+				replace_numbers=replace_numbers,
+				n_process=n_process,
+				verbose=self.verbose
+			)
+			if lemmatize:
+				# lemmatize tokens
+				tokens = lemmatize_corpus(tokens, nlp_es, nlp_cat, n_process=n_process, verbose=self.verbose)
+			return tokens
+
+		path = os.path.join(self.save_dir, file_name)
+		if self.cache is None:
+			tokens = compute(list(range(len(data))))
+		else:
+			options = {"lemmatize": lemmatize, "remove_punctuation": remove_punctuation, "replace_numbers": replace_numbers}
+			tokens = self.cache.map(data, "tokens", options, compute,\
+						   doc_tokens_to_json, doc_tokens_from_json, manifest_path=path)
 		# save to file
-		save_tokens(tokens, os.path.join(self.save_dir, file_name))
+		save_tokens(tokens, path)
 		return tokens
 	
+	def create_preprocessed(
+			self,
+			data: List[dict],
+			prefix: str,
+			lemmatize: bool = False,
+			remove_punctuation: bool = True,
+			replace_numbers: Optional[str] = None,
+			n_process: int = 1
+	) -> List[dict]:
+		"""
+		Tokenize, POS tag and lemmatize the data in a single pass and save the aligned result
+		to {prefix}preprocessed.json, as well as the tokens, POS tags and lemmas to
+		{prefix}tokens.json, {prefix}pos.json and {prefix}lemmas.json.
+		Only the documents missing in the cache are preprocessed.
+		"""
+		def compute(idxs: List[int]) -> List[List[dict]]:
+			sents = sent_tokenize_corpus([data[i] for i in idxs], verbose=self.verbose)
+			nlp_es, nlp_cat = load_nlps("lemmatizer")
+			return preprocess_corpus(
+				sents, nlp_es, nlp_cat,
+				remove_punctuation=remove_punctuation,
+				replace_numbers=replace_numbers,
+				n_process=n_process,
+				verbose=self.verbose
+			)
+
+		path = os.path.join(self.save_dir, prefix + "preprocessed.json")
+		options = self.preprocessed_options(remove_punctuation, replace_numbers)
+		if self.cache is None:
+			preprocessed = compute(list(range(len(data))))
+		else:
+			preprocessed = self.cache.map(data, "preprocessed", options, compute,\
+								 doc_tokens_to_json, doc_tokens_from_json, manifest_path=path)
+		save_tokens(preprocessed, path)
+		tokens, pos, lemmas = split_preprocessed(preprocessed, lemmatize)
+		save_tokens(tokens, os.path.join(self.save_dir, prefix + "tokens.json"))
+		with open(os.path.join(self.save_dir, prefix + "pos.json"), 'w', encoding='utf8') as _f:
+			json.dump(pos, _f)
+		with open(os.path.join(self.save_dir, prefix + "lemmas.json"), 'w', encoding='utf8') as _f:
+			json.dump(lemmas, _f)
+		if self.cache is not None:
+			# tokens are the same as create_tokens gives, but not the POS tags
+			token_options = {"lemmatize": lemmatize, **options}
+			self.cache.write_manifest(os.path.join(self.save_dir, prefix + "tokens.json"),\
+							 self.cache.keys(data, "tokens", token_options))
+			for name in ("pos.json", "lemmas.json"):
+				self.cache.write_manifest(os.path.join(self.save_dir, prefix + name), self.cache.keys(data, "preprocessed", options))
+		return preprocessed
+
+	def preprocessed_options(
+			self,
+			remove_punctuation: Optional[bool] = None,
+			replace_numbers: Optional[str] = None
+	) -> dict:
+		"""
+		Options the output of create_preprocessed depends on. Defaults to the ones of the model.
+		"""
+		return {
+			"remove_punctuation": self.token_options["remove_punctuation"] if remove_punctuation is None else remove_punctuation,
+			"replace_numbers": self.token_options["replace_numbers"] if replace_numbers is None else replace_numbers
+		}
+
+	def create_annotations(
+			self,
+			data: List[dict],
+			tokens_file: str,
+			file_name: str,
+			kind: str,
+			compute_fn: Callable[..., List[List[List[str]]]]
+	) -> List[List[List[str]]]:
+		"""
+		Compute token level annotations (e.g. crf.compute_pos or lstm.compute_lemmas) from a
+		tokens file and save them. Only the documents missing in the cache are annotated.
+		"""
+		tokens = load_tokens(os.path.join(self.save_dir, tokens_file))
+		def compute(idxs: List[int]) -> List[List[List[str]]]:
+			return compute_fn([tokens[i] for i in idxs], verbose=self.verbose)
+
+		path = os.path.join(self.save_dir, file_name)
+		if self.cache is None:
+			annotations = compute(list(range(len(tokens))))
+		else:
+			annotations = self.cache.map(data, kind, self.token_options, compute, manifest_path=path)
+		with open(path, 'w', encoding='utf8') as _f:
+			json.dump(annotations, _f)
+		return annotations
+
 	def load_tokens(self) -> List[dict]:
 		return load_tokens(os.path.join(self.save_dir, "data_tokens.json"))
 	
@@ -213,12 +360,32 @@ class EnhancedEvalModel(EvalModel):
 	):
 		"""
 		Abstract class for evaluation models that require additional preprocessing (CRF and LSTM)
+		If fused_preprocessing is passed as True, tokens, POS tags and lemmas are computed in
+		a single pass (see create_preprocessed).
 		"""
+		self.fused = kwargs.get("fused_preprocessing", False)
 		super(EnhancedEvalModel, self).__init__(save_dir, results_dir, eval_data_path, load_existing_eval_tokens, **kwargs)
 		self.train_data_path = train_data_path
 		self.eval_data_path = eval_data_path
 		self.train_data = self.load_data(self.train_data_path)
-		if not load_existing_train_tokens:
+		if self.fused:
+			for data, prefix, load_existing in ((self.data, "data_", load_existing_eval_tokens),\
+									   (self.train_data, "train_data_", load_existing_train_tokens)):
+				if self.reuse(load_existing, prefix + "preprocessed.json", data, "preprocessed", self.preprocessed_options()) and\
+					self.reuse(load_existing, prefix + "tokens.json", data, "tokens", self.token_options) and\
+					self.reuse(load_existing, prefix + "pos.json", data, "preprocessed", self.preprocessed_options()) and\
+					self.reuse(load_existing, prefix + "lemmas.json", data, "preprocessed", self.preprocessed_options()):
+					continue
+				if self.verbose: print(f"Preprocessing {prefix[:-1]}...")
+				self.create_preprocessed(
+					data=data,
+					prefix=prefix,
+					lemmatize=kwargs.get("lemmatize", False),
+					remove_punctuation=kwargs.get("remove_punctuation", True),
+					replace_numbers=kwargs.get("replace_numbers", None),
+					n_process=kwargs.get("n_process", 1)
+				)
+		elif not self.reuse(load_existing_train_tokens, "train_data_tokens.json", self.train_data, "tokens", self.token_options):
 			# Tokenize training data and save tokens
 			if self.verbose: print("Creating training tokens...")
 			self.create_tokens(
@@ -226,30 +393,26 @@ class EnhancedEvalModel(EvalModel):
 				file_name="train_data_tokens.json",
 				lemmatize=kwargs.get("lemmatize", False),
 				remove_punctuation=kwargs.get("remove_punctuation", True),
-				replace_numbers=kwargs.get("replace_numbers", None)
+				replace_numbers=kwargs.get("replace_numbers", None),
+				n_process=kwargs.get("n_process", 1)
 			)
 		# Create labels for training data
 		train_data_bio = crf.create_bio_tags(self.train_data, load_tokens(os.path.join(self.save_dir, "train_data_tokens.json")))
 		with open(os.path.join(self.save_dir, "train_data_bio.json"), 'w', encoding='utf8') as _f:
 			json.dump(train_data_bio, _f)
-		if not load_existing_train_pos:
+		if not self.fused and\
+			not self.reuse(load_existing_train_pos, "train_data_pos.json", self.train_data, "pos", self.token_options):
 			# Create POS tags for training data
 			if self.verbose: print("Precomputing training POS tags...")
-			crf.precompute_pos(
-				tokens_path=os.path.join(self.save_dir, "train_data_tokens.json"),
-				pos_path=os.path.join(self.save_dir, "train_data_pos.json"),
-				verbose=self.verbose
-			)
-		if not load_existing_eval_pos:
+			self.create_annotations(self.train_data, "train_data_tokens.json", "train_data_pos.json", "pos", crf.compute_pos)
+		if not self.fused and\
+			not self.reuse(load_existing_eval_pos, "data_pos.json", self.data, "pos", self.token_options):
 			# Create POS tags for evaluation data
 			if self.verbose: print("Precomputing evaluation POS tags...")
-			crf.precompute_pos(
-				tokens_path=os.path.join(self.save_dir, "data_tokens.json"),
-				pos_path=os.path.join(self.save_dir, "data_pos.json"),
-				verbose=self.verbose
-			)
+			self.create_annotations(self.data, "data_tokens.json", "data_pos.json", "pos", crf.compute_pos)
 		if self.verbose: print("Loading NLP models...")
-		self.nlps = load_nlps()
+		self.nlps = load_nlps("lemmatizer")
+		if self.verbose: print("Loaded models:", registry.stats())
 		self.name = "Enhanced"
 		self.model = None
 		self.kwargs = kwargs
@@ -423,7 +586,9 @@ class EvalNegex(EvalModel):
 		Process the evaluation data using Negex and write the predictions to a file.
 		"""
 		tokens = self.load_tokens()
-		predictions = negex.process_data(tokens, max_context_size=kwargs.get("max_context_size", 5))
+		predictions = negex.process_data(tokens, max_context_size=kwargs.get("max_context_size", 5),\
+			medical_terms_path=kwargs.get("medical_terms_path"),\
+			negation_speculation_path=kwargs.get("negation_speculation_path"))
 		negex.write_predictions(self.data, predictions, "data_predictions.json", dir=self.save_dir.split("/")[-1])
 
 class EvalCRF(EnhancedEvalModel):
@@ -454,7 +619,8 @@ class EvalCRF(EnhancedEvalModel):
 			data_path=self.data_path,
 			tokens_path=os.path.join(self.save_dir, "data_tokens.json"),
 			save_path=os.path.join(self.save_dir, "data_predictions.json"),
-			pos_path=os.path.join(self.save_dir, "data_pos.json"),		
+			pos_path=os.path.join(self.save_dir, "data_pos.json"),
+			n_workers=self.kwargs.get("n_workers", 1)
 		)
 
 	def evaluate(self, **kwargs) -> dict:
@@ -477,7 +643,9 @@ class EvalCRF(EnhancedEvalModel):
 		self.model.train(
 			train_tokens_path=os.path.join(self.save_dir, "train_data_tokens.json"),
 			train_labels_path=os.path.join(self.save_dir, "train_data_bio.json"),
-			train_pos_path=os.path.join(self.save_dir, "train_data_pos.json")
+			train_pos_path=os.path.join(self.save_dir, "train_data_pos.json"),
+			# trials with the same feature parameters share the training features
+			features_path=os.path.join(self.save_dir, "features", "train_" + self.model.extractor.key())
 		)
 		# Evaluate and return metrics
 		hyperparams = kwargs
@@ -486,6 +654,85 @@ class EvalCRF(EnhancedEvalModel):
 		hyperparams["replace_numbers"] = self.kwargs.get("replace_numbers", None)
 		return super(EvalCRF, self).evaluate(**hyperparams)
 
+	def search(
+			self,
+			params_list: List[dict],
+			n_workers: Optional[int] = 1
+	) -> List[dict]:
+		"""
+		Train and evaluate a CRF for each combination of hyperparameters (see crf.search):
+		training features are built once per feature parameters and trials run in
+		n_workers processes, each writing its own model.
+		The metrics include the training time and the time to tag the (already loaded)
+		evaluation data, as train_time and tag_time: they are not comparable with the time
+		of evaluate, which also reads the inputs and writes the predictions.
+			Returns the combinations sorted from best to worst.
+		"""
+		trials = crf.search(
+			[{k: v for k, v in params.items() if k not in crf.EVAL_PARAMS} for params in params_list],
+			train_tokens_path=os.path.join(self.save_dir, "train_data_tokens.json"),
+			train_labels_path=os.path.join(self.save_dir, "train_data_bio.json"),
+			train_pos_path=os.path.join(self.save_dir, "train_data_pos.json"),
+			eval_tokens_path=os.path.join(self.save_dir, "data_tokens.json"),
+			eval_pos_path=os.path.join(self.save_dir, "data_pos.json"),
+			save_dir=self.save_dir,
+			n_workers=n_workers,
+			verbose=self.verbose
+		)
+		combinations = []
+		for params, trial in zip(params_list, trials):
+			predictions = [dict(doc, predictions=[{"result": results}]) for doc, results in zip(self.data, trial["results"])]
+			p, r, f1 = self.calc(predictions, self.data)
+			metrics = {
+				"precision": p,
+				"recall": r,
+				"f1": f1,
+				"train_time": round(trial["train_time"], 4),
+				"tag_time": round(trial["predict_time"], 4)
+			}
+			hyperparams = {k: v for k, v in params.items() if k != "save_results"}
+			if params.get("save_results", True):
+				hyperparams["lemmatize"] = self.kwargs.get("lemmatize", False)
+				hyperparams["remove_punctuation"] = self.kwargs.get("remove_punctuation", True)
+				hyperparams["replace_numbers"] = self.kwargs.get("replace_numbers", None)
+				self.save_results(metrics, hyperparams)
+			combinations.append({"params": params, "metrics": metrics, "model_path": trial["model_path"]})
+		# Sort from best to worst
+		return sorted(combinations, key=lambda x: x["metrics"]["f1"], reverse=True)
+
+	def grid_search(
+			self,
+			params_ranges: dict,
+			n_workers: Optional[int] = 1
+	) -> List[dict]:
+		"""
+		Perform grid search over the hyperparameters (see search).
+		"""
+		keys = list(params_ranges.keys())
+		# same order as EnhancedEvalModel.grid_search, the first parameter changes fastest
+		params_list = [{key: value for key, value in zip(keys, reversed(values))}\
+			for values in itertools.product(*reversed(list(params_ranges.values())))]
+		return self.search(params_list, n_workers)
+
+	def random_search(
+			self,
+			params_ranges: dict,
+			n_iter: int,
+			n_workers: Optional[int] = 1
+	) -> List[dict]:
+		"""
+		Perform random search over the hyperparameters (see search).
+		"""
+		params_list = []
+		for _ in range(n_iter):
+			# Randomly sample a combination of hyperparameters
+			while True:
+				params = {key: random.choice(values) for key, values in params_ranges.items()}
+				if params not in params_list:
+					break
+			params_list.append(params)
+		return self.search(params_list, n_workers)
+
 class EvalLSTM(EnhancedEvalModel):
 	def __init__(
 			self,
@@ -508,22 +755,17 @@ class EvalLSTM(EnhancedEvalModel):
 		"""
 		super(EvalLSTM, self).__init__(save_dir, results_dir, train_data_path, eval_data_path, load_existing_train_tokens,\
 								load_existing_eval_tokens, load_existing_train_pos, load_existing_eval_pos, **kwargs)
-		if not load_existing_train_lemmas:
+		compute_lemmas = lambda tokens, verbose: lstm.compute_lemmas(tokens, self.nlps, verbose)
+		if not self.fused and\
+			not self.reuse(load_existing_train_lemmas, "train_data_lemmas.json", self.train_data, "lemmas", self.token_options):
 			# Precompute lemmas for training data
 			if self.verbose: print("Precomputing training lemmas...")
-			lstm.precompute_lemmas(
-				tokens_path=os.path.join(self.save_dir, "train_data_tokens.json"),
-				lemmas_path=os.path.join(self.save_dir, "train_data_lemmas.json"),
-				verbose=self.verbose
-			)
-		if not load_existing_eval_lemmas:
+			self.create_annotations(self.train_data, "train_data_tokens.json", "train_data_lemmas.json", "lemmas", compute_lemmas)
+		if not self.fused and\
+			not self.reuse(load_existing_eval_lemmas, "data_lemmas.json", self.data, "lemmas", self.token_options):
 			# Precompute lemmas for evaluation data
 			if self.verbose: print("Precomputing evaluation lemmas...")
-			lstm.precompute_lemmas(
-				tokens_path=os.path.join(self.save_dir, "data_tokens.json"),
-				lemmas_path=os.path.join(self.save_dir, "data_lemmas.json"),
-				verbose=self.verbose
-			)
+			self.create_annotations(self.data, "data_tokens.json", "data_lemmas.json", "lemmas", compute_lemmas)
 		if fasttext_model is None:
 			if self.verbose: print("Loading FastText model...")
 			self.ft = lstm.load_fasttext()
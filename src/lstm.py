@@ -6,28 +6,43 @@ import fasttext
 import fasttext.util
 from sklearn.preprocessing import OneHotEncoder
 from preprocessing import *
+import registry
+
+def compute_lemmas(
+		tokens: List[List[Dict[str, Any]]],
+		nlps: Optional[Tuple[Any, Any]] = None,
+		verbose: bool = False
+) -> List[List[List[str]]]:
+	"""
+	Computes lemmas for the given tokens.
+	"""
+	if nlps is None:
+		nlps = load_nlps("lemmatizer")
+	nlp_es, nlp_ca = nlps
+	lemmas = lemmatize_corpus(tokens, nlp_es, nlp_ca, verbose=verbose)
+	return [[sent["tokens"].tolist() for sent in doc] for doc in lemmas]
 
 def precompute_lemmas(
 		tokens_path: str,
 		lemmas_path: str,
+		nlps: Optional[Tuple[Any, Any]] = None,
 		verbose: bool = False
 ):
 	"""
 	Precomputes lemmas for the given tokens and saves them to a file.
 	"""
-	nlp_es, nlp_ca = load_nlps()
 	lemmas_dir = os.path.dirname(lemmas_path)
 	if not os.path.exists(lemmas_dir):
 		os.makedirs(lemmas_dir)
-	tokens = load_tokens(tokens_path)
-	lemmas = lemmatize_corpus(tokens, nlp_es, nlp_ca, verbose)
-	lemmas = [[sent["tokens"].tolist() for sent in doc] for doc in lemmas]
+	lemmas = compute_lemmas(load_tokens(tokens_path), nlps, verbose)
 	with open(lemmas_path, "w") as f:
 		json.dump(lemmas, f)
 
 def load_fasttext() -> fasttext.FastText._FastText:
-	fasttext.util.download_model("es", if_exists="ignore")
-	return fasttext.load_model("cc.es.300.bin")
+	"""
+	Returns the Spanish FastText model, loaded once per process.
+	"""
+	return registry.get_fasttext("es")
 
 def load_data(
 		tokens_path: str,
@@ -1,8 +1,19 @@
 from preprocessing import *
 import blindNegex
+from terms import TermTrie
 import os
+import threading
+from time import time
+from typing import Iterable
+import registry
+from parallel import parallel_map
 
 ROOT_DIR = os.path.dirname(os.path.abspath(""))
+# default lexicons, located from the source tree rather than the working directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+# Number of sentences processed by process_sent, and of those dropped because processing failed
+sentence_stats = {"sentences": 0, "failed": 0}
 
 def get_medical_terms(
 		tokens: np.ndarray,
@@ -29,24 +40,92 @@ def prepare_negation_speculation(
 	speculation_dirs = tags[np.where(np.isin(words, speculation_words))[0]]
 	return negation_words, negation_dirs, speculation_words, speculation_dirs
 
+class Lexicon:
+	def __init__(
+			self,
+			medical_terms: np.ndarray,
+			negation_words: np.ndarray,
+			negation_dirs: np.ndarray,
+			speculation_words: np.ndarray,
+			speculation_dirs: np.ndarray
+	):
+		"""
+		Maps every word of the lexicons to an integer id (0 for unknown words) with flags telling
+		whether it is a medical term, a negation or a speculation word, and its direction.
+		Built once, it classifies the tokens of a sentence with a dictionary lookup per token and
+		vectorized indexing, instead of sorting the lexicons for every sentence, and gives the
+		direction of each cue from its id.
+		Multi-word medical terms go to a TermTrie, only walked from the tokens that start one.
+		"""
+		medical_terms = [str(term) for term in medical_terms]
+		multi_word = [term for term in medical_terms if len(term.split()) > 1]
+		medical_terms = [term for term in medical_terms if len(term.split()) <= 1]
+		self.term_trie = TermTrie(multi_word) if multi_word else None
+		first_words = self.term_trie.first_words() if self.term_trie is not None else []
+		self.vocab = {}
+		for word in (*medical_terms, *negation_words, *speculation_words, *first_words):
+			self.vocab.setdefault(str(word), len(self.vocab) + 1)
+		size = len(self.vocab) + 1
+		self.starts_term = np.zeros(size, dtype=bool)
+		self.starts_term[self.ids(first_words)] = True
+		self.is_term = np.zeros(size, dtype=bool)
+		self.is_negation = np.zeros(size, dtype=bool)
+		self.is_speculation = np.zeros(size, dtype=bool)
+		self.direction = np.zeros(size, dtype=int)
+		self.is_term[self.ids(medical_terms)] = True
+		self.is_negation[self.ids(negation_words)] = True
+		self.is_speculation[self.ids(speculation_words)] = True
+		self.direction[self.ids(negation_words)] = negation_dirs
+		self.direction[self.ids(speculation_words)] = speculation_dirs
+
+	def ids(
+			self,
+			tokens: np.ndarray
+	) -> np.ndarray:
+		"""
+		Returns the id of each token.
+		"""
+		return np.fromiter((self.vocab.get(token, 0) for token in tokens), dtype=np.int64, count=len(tokens))
+
+	def terms_bin(
+			self,
+			tokens: np.ndarray,
+			ids: Optional[np.ndarray] = None
+	) -> np.ndarray:
+		"""
+		Returns a binary array telling which tokens belong to a single or multi-word medical term.
+		"""
+		if ids is None:
+			ids = self.ids(tokens)
+		terms_bin = self.is_term[ids]
+		if self.term_trie is not None:
+			starts = np.where(self.starts_term[ids])[0]
+			for start, end in self.term_trie.find(tokens, starts):
+				terms_bin[start:end] = True
+		return terms_bin
+
 def get_indices(
 		tokens: np.ndarray,
-		terms: np.ndarray,
+		terms: Optional[np.ndarray],
 		negation_words: np.ndarray,
 		negation_dirs: np.ndarray,
 		speculation_words: np.ndarray,
 		speculation_dirs: np.ndarray,
+		lexicon: Optional[Lexicon] = None
 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
 	"""
 	Returns the indices of the negation and speculation words in the tokens, and their directions.
+	If a lexicon is given, tokens are classified with it and terms is not used, otherwise
+	a lexicon is built from terms and the negation and speculation words.
 	"""
-	neg_bin = np.isin(tokens, negation_words)
-	neg_idx = np.where(neg_bin)[0]
-	neg_dir = negation_dirs[neg_idx]
-	unc_bin = np.isin(tokens, speculation_words)
-	unc_idx = np.where(unc_bin)[0]
-	unc_dir = speculation_dirs[unc_idx]
-	terms_bin = np.isin(tokens, terms)
+	if lexicon is None:
+		lexicon = Lexicon(terms, negation_words, negation_dirs, speculation_words, speculation_dirs)
+	ids = lexicon.ids(tokens)
+	neg_idx = np.where(lexicon.is_negation[ids])[0]
+	neg_dir = lexicon.direction[ids[neg_idx]]
+	unc_idx = np.where(lexicon.is_speculation[ids])[0]
+	unc_dir = lexicon.direction[ids[unc_idx]]
+	terms_bin = lexicon.terms_bin(tokens, ids)
 	terms_idx = np.where(terms_bin)[0]
 	return neg_idx, neg_dir, unc_idx, unc_dir, terms_idx, terms_bin
 
@@ -61,18 +140,30 @@ def _find_regions(data):
 		ends = np.r_[ends, len(data)]
 	return list(zip(starts, ends))
 
+def _merge_regions(a_regions, b_regions):
+	"""
+	Sweep-line over two sorted lists of disjoint regions: returns the union of every
+	pair of overlapping regions, in O(a+b).
+	"""
+	merged = []
+	i = j = 0
+	while i < len(a_regions) and j < len(b_regions):
+		a_start, a_end = a_regions[i]
+		b_start, b_end = b_regions[j]
+		if a_start < b_end and a_end > b_start:
+			merged.append((min(a_start, b_start), max(a_end, b_end)))
+		# the region that ends first can not overlap the following ones
+		if a_end <= b_end:
+			i += 1
+		else:
+			j += 1
+	return merged
+
 def _combine_regions(a, b):
 	"""Combine regions from two binary arrays based on overlap criteria"""
-	a_regions = _find_regions(a)
-	b_regions = _find_regions(b)
 	result = np.zeros_like(a, dtype=int)
-
-	for a_start, a_end in a_regions:
-		for b_start, b_end in b_regions:
-			if (a_start < b_end and a_end > b_start):
-				start = min(a_start, b_start)
-				end = max(a_end, b_end)
-				result[start:end] = 1
+	for start, end in _merge_regions(_find_regions(a), _find_regions(b)):
+		result[start:end] = 1
 	return result
 
 def get_contexts_bin(
@@ -106,6 +197,52 @@ def get_contexts_bin(
 	context_bin = [_combine_regions(terms_bin.astype(int), context_bin[i].astype(int)) for i in range(len(neg_idx))]
 	return context_bin
 
+def get_context_regions(
+		terms_bin: np.ndarray,
+		terms_idx: np.ndarray,
+		neg_idx: np.ndarray,
+		neg_dir: np.ndarray,
+		max_context_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Same contexts as get_contexts_bin, computed for all the negation or speculation words
+	of a sentence at once and returned as token regions instead of binary arrays.
+	The context of each word is extended with the medical terms it overlaps, looking up the
+	first and last overlapping term region with a binary search over the sorted regions.
+		Returns the start and end (exclusive) token indices of each context.
+		Raises ValueError if a word has no medical term in its context.
+	"""
+	if len(neg_idx) == 0:
+		return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+	context_dis = terms_idx[None, :] - neg_idx[:, None] # distance from the term to the negation word
+	context_bin = np.sign(context_dis) == neg_dir[:, None] # full context in the direction of the negation word
+	context_bin &= np.abs(context_dis) <= max_context_size # context within a certain distance
+	# closest end of the context, as in get_contexts_bin
+	context_end = np.where(context_bin, terms_idx[None, :], -1).max(axis=1, initial=-1)
+	if np.any(context_end == -1):
+		raise ValueError("Negation or speculation word without context")
+	forward = neg_dir == 1
+	starts = np.where(forward, neg_idx + 1, context_end)
+	ends = np.where(forward, context_end + 1, neg_idx)
+	# extend the contexts with the medical terms they overlap
+	regions = np.array(_find_regions(terms_bin.astype(int)), dtype=int).reshape(-1, 2)
+	first = np.searchsorted(regions[:, 1], starts, side="right")
+	last = np.searchsorted(regions[:, 0], ends, side="left") - 1
+	overlap = first <= last
+	starts[overlap] = np.minimum(starts[overlap], regions[first[overlap], 0])
+	ends[overlap] = np.maximum(ends[overlap], regions[last[overlap], 1])
+	return starts, ends
+
+def get_regions_span(
+		spans: np.ndarray,
+		regions: Tuple[np.ndarray, np.ndarray]
+) -> List[List[int]]:
+	"""
+	Returns the start and end character indices of the given token regions.
+	"""
+	starts, ends = regions
+	return [[spans[start][0], spans[end - 1][1]] for start, end in zip(starts, ends)]
+
 def get_contexts_span(
 		spans: np.ndarray,
 		contexts_bin: List[np.ndarray]
@@ -138,21 +275,29 @@ def process_sent(
 		negation_dirs: np.ndarray,
 		speculation_words: np.ndarray,
 		speculation_dirs: np.ndarray,
-		max_context_size: int
+		max_context_size: int,
+		lexicon: Optional[Lexicon] = None,
+		stats: Optional[Dict[str, int]] = None
 ) -> List[Dict]:
 	"""
 	Processes a sentence and returns the negation and speculation contexts.
+	If a lexicon is given, it is used to classify the tokens (see Lexicon).
+	Sentences that fail are dropped and counted in stats (defaults to sentence_stats).
 	"""
+	if stats is None:
+		stats = sentence_stats
+	stats["sentences"] += 1
 	try:
-		terms = get_medical_terms(sent["tokens"], all_medical_terms)
+		terms = get_medical_terms(sent["tokens"], all_medical_terms) if lexicon is None else None
 		neg_idx, neg_dir, unc_idx, unc_dir, terms_idx, terms_bin = \
-			get_indices(sent["tokens"], terms, negation_words, negation_dirs, speculation_words, speculation_dirs)
-		neg_contexts_bin = get_contexts_bin(terms_bin, terms_idx, neg_idx, neg_dir, max_context_size)
-		spec_contexts_bin = get_contexts_bin(terms_bin, terms_idx, unc_idx, unc_dir, max_context_size)
-		neg_contexts_span = get_contexts_span(sent["spans"], neg_contexts_bin)
-		spec_contexts_span = get_contexts_span(sent["spans"], spec_contexts_bin)
+			get_indices(sent["tokens"], terms, negation_words, negation_dirs, speculation_words, speculation_dirs, lexicon)
+		neg_regions = get_context_regions(terms_bin, terms_idx, neg_idx, neg_dir, max_context_size)
+		spec_regions = get_context_regions(terms_bin, terms_idx, unc_idx, unc_dir, max_context_size)
+		neg_contexts_span = get_regions_span(sent["spans"], neg_regions)
+		spec_contexts_span = get_regions_span(sent["spans"], spec_regions)
 		return save_spans((neg_contexts_span, spec_contexts_span))
-	except:
+	except Exception:
+		stats["failed"] += 1
 		return []
 	
 def process_doc(
@@ -162,7 +307,9 @@ def process_doc(
 		negation_dirs: np.ndarray,
 		speculation_words: np.ndarray,
 		speculation_dirs: np.ndarray,
-		max_context_size: int
+		max_context_size: int,
+		lexicon: Optional[Lexicon] = None,
+		stats: Optional[Dict[str, int]] = None
 ) -> List[Dict]:
 	"""
 	Processes a document and returns the negation and speculation contexts.
@@ -176,35 +323,179 @@ def process_doc(
 			negation_dirs,
 			speculation_words,
 			speculation_dirs,
-			max_context_size
+			max_context_size,
+			lexicon,
+			stats
 		)
 		all_spans.extend(spans)
 	return {"result": all_spans}
 
-def process_data(
-		data: List[List[Dict]],
-		max_context_size: int = 5
-) -> List[Dict]:
+def _init_worker(*context) -> Tuple:
 	"""
-	Processes a list of documents and returns the negation and speculation contexts.
+	Context of a parallel worker, the engine is shipped once per worker.
 	"""
-	predictions = []
-	all_medical_terms = np.array(read_terms(os.path.join(ROOT_DIR, "data", "medical_terms.txt")))
-	negation_speculation_path = os.path.join(ROOT_DIR, "data", "negation_speculation_word.txt")
-	negation_words, negation_dirs, speculation_words, speculation_dirs = \
-		prepare_negation_speculation(negation_speculation_path)
-	for doc in tqdm(data):
+	return context
+
+def _process_doc_worker(
+		doc: List[Dict],
+		context: Tuple
+) -> Tuple[Dict, Dict[str, int]]:
+	"""
+	Processes a document in a parallel worker.
+		Returns the contexts and the number of sentences processed and failed in the document.
+	"""
+	engine, max_context_size = context
+	return engine._process_doc(doc, max_context_size)
+
+class NegexEngine:
+	def __init__(
+			self,
+			medical_terms_path: Optional[str] = None,
+			negation_speculation_path: Optional[str] = None
+	):
+		"""
+		Loads and compiles the NegEx lexicons once, to process documents on demand.
+		Parameters:
+		- medical_terms_path: file with a medical term per line. Defaults to data/medical_terms.txt.
+		- negation_speculation_path: file with the negation and speculation words.
+			Defaults to data/negation_speculation_word.txt.
+
+		The lexicons are not modified after loading, so an engine can be shared across calls
+		and threads. The number of sentences processed and failed is kept in stats.
+		"""
+		if medical_terms_path is None:
+			medical_terms_path = os.path.join(DATA_DIR, "medical_terms.txt")
+		if negation_speculation_path is None:
+			negation_speculation_path = os.path.join(DATA_DIR, "negation_speculation_word.txt")
+		self.medical_terms_path = medical_terms_path
+		self.negation_speculation_path = negation_speculation_path
+		self.all_medical_terms = np.array(read_terms(medical_terms_path))
+		self.negation_words, self.negation_dirs, self.speculation_words, self.speculation_dirs = \
+			prepare_negation_speculation(negation_speculation_path)
+		self.lexicon = Lexicon(self.all_medical_terms, self.negation_words, self.negation_dirs,\
+			self.speculation_words, self.speculation_dirs)
+		self.stats = {"sentences": 0, "failed": 0}
+		self._lock = threading.Lock()
+
+	def __getstate__(self) -> Dict:
+		state = self.__dict__.copy()
+		del state["_lock"]
+		return state
+
+	def __setstate__(self, state: Dict) -> None:
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def _process_doc(
+			self,
+			doc: List[Dict],
+			max_context_size: int
+	) -> Tuple[Dict, Dict[str, int]]:
+		stats = {"sentences": 0, "failed": 0}
 		spans = process_doc(
 			doc,
-			all_medical_terms,
-			negation_words,
-			negation_dirs,
-			speculation_words,
-			speculation_dirs,
-			max_context_size
+			self.all_medical_terms,
+			self.negation_words,
+			self.negation_dirs,
+			self.speculation_words,
+			self.speculation_dirs,
+			max_context_size,
+			self.lexicon,
+			stats
 		)
-		predictions.append(spans)
-	return predictions
+		return spans, stats
+
+	def _add_stats(
+			self,
+			stats: Dict[str, int]
+	) -> None:
+		with self._lock:
+			for key, value in stats.items():
+				self.stats[key] += value
+				sentence_stats[key] += value
+
+	def process_doc(
+			self,
+			doc: List[Dict],
+			max_context_size: int = 5
+	) -> Dict:
+		"""
+		Processes a document (list of tokenized sentences) and returns the negation and
+		speculation contexts.
+		"""
+		spans, stats = self._process_doc(doc, max_context_size)
+		self._add_stats(stats)
+		return spans
+
+	def process_batch(
+			self,
+			data: List[List[Dict]],
+			max_context_size: int = 5,
+			n_workers: Optional[int] = 1,
+			chunk_size: int = 16,
+			return_stats: bool = False,
+			verbose: bool = True
+	) -> Union[List[Dict], Tuple[List[Dict], Dict[int, Dict[str, float]]]]:
+		"""
+		Processes a list of documents and returns the negation and speculation contexts.
+		If n_workers is not 1, documents are processed in chunks of chunk_size over a pool of
+		n_workers processes (None for all the CPUs). With return_stats, the throughput stats
+		of each worker are also returned.
+		"""
+		start = time()
+		if n_workers != 1:
+			results, worker_stats = parallel_map(_process_doc_worker, data, _init_worker, (self, max_context_size),\
+										n_workers=n_workers, chunk_size=chunk_size, verbose=verbose)
+		else:
+			results = [self._process_doc(doc, max_context_size) for doc in tqdm(data, disable=not verbose)]
+			worker_stats = {os.getpid(): {"items": len(data), "time": time() - start,\
+				"throughput": len(data) / max(time() - start, 1e-9)}}
+		predictions = [spans for spans, _ in results]
+		stats = {
+			"sentences": sum(doc_stats["sentences"] for _, doc_stats in results),
+			"failed": sum(doc_stats["failed"] for _, doc_stats in results)
+		}
+		self._add_stats(stats)
+		if stats["failed"]:
+			print(f"Warning: {stats['failed']} of {stats['sentences']} sentences failed and were dropped")
+		return (predictions, worker_stats) if return_stats else predictions
+
+def get_engine(
+		medical_terms_path: Optional[str] = None,
+		negation_speculation_path: Optional[str] = None
+) -> NegexEngine:
+	"""
+	Returns the shared NegexEngine of the given lexicons (see NegexEngine), loading it the
+	first time. If a lexicon file was modified since then, the engine is loaded again and
+	replaces the previous one.
+	"""
+	paths = [
+		os.path.abspath(medical_terms_path or os.path.join(DATA_DIR, "medical_terms.txt")),
+		os.path.abspath(negation_speculation_path or os.path.join(DATA_DIR, "negation_speculation_word.txt"))
+	]
+	key = ("negex", ";".join(paths), None)
+	mtimes = tuple(os.path.getmtime(path) for path in paths)
+	return registry.get_model(key, lambda: NegexEngine(*paths), mtimes)
+
+def process_data(
+		data: List[List[Dict]],
+		max_context_size: int = 5,
+		n_workers: Optional[int] = 1,
+		chunk_size: int = 16,
+		return_stats: bool = False,
+		medical_terms_path: Optional[str] = None,
+		negation_speculation_path: Optional[str] = None
+) -> Union[List[Dict], Tuple[List[Dict], Dict[int, Dict[str, float]]]]:
+	"""
+	Processes a list of documents and returns the negation and speculation contexts.
+	The lexicons are loaded once per process and reused across calls (see get_engine).
+	If n_workers is not 1, documents are processed in chunks of chunk_size over a pool of
+	n_workers processes (None for all the CPUs). With return_stats, the throughput stats
+	of each worker are also returned.
+	The number of sentences that failed and were dropped is added to sentence_stats.
+	"""
+	engine = get_engine(medical_terms_path, negation_speculation_path)
+	return engine.process_batch(data, max_context_size, n_workers, chunk_size, return_stats)
 
 def _convert_int64_to_int(obj):
 	"""Converts an np.int64 object to int"""
@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from tqdm import tqdm
+
+# State of each worker process, set once by the pool initializer
+_worker_context = None
+
+def _init_worker(
+		init_fn: Optional[Callable[..., Any]],
+		init_args: Tuple
+) -> None:
+	"""
+	Pool initializer: builds the context shared by all the tasks of a worker.
+	"""
+	global _worker_context
+	_worker_context = init_fn(*init_args) if init_fn is not None else None
+
+def _process_chunk(
+		process_fn: Callable[[Any, Any], Any],
+		chunk_idx: int,
+		chunk: List[Any]
+) -> Tuple[int, List[Any], int, float]:
+	"""
+	Process a chunk of items in a worker.
+		Returns the chunk index, the results, the worker pid and the time spent.
+	"""
+	start = time()
+	results = [process_fn(item, _worker_context) for item in chunk]
+	return chunk_idx, results, os.getpid(), time() - start
+
+def parallel_map(
+		process_fn: Callable[[Any, Any], Any],
+		items: List[Any],
+		init_fn: Optional[Callable[..., Any]] = None,
+		init_args: Tuple = (),
+		n_workers: Optional[int] = None,
+		chunk_size: int = 16,
+		verbose: bool = False
+) -> Tuple[List[Any], Dict[int, Dict[str, float]]]:
+	"""
+	Apply process_fn to every item over a pool of processes.
+	Parameters:
+	- process_fn: module level function called as process_fn(item, context).
+	- items: the items to process (e.g. documents).
+	- init_fn: module level function called once per worker as init_fn(*init_args) to build
+		the context, so large tables are shipped once per worker instead of once per task.
+	- n_workers: number of processes, defaults to the number of CPUs.
+	- chunk_size: number of items sent to a worker per task.
+
+	Returns the results in the same order as the items, and the number of items, busy time
+		and throughput (items/s) of each worker, by pid.
+	"""
+	chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+	results = [None] * len(chunks)
+	stats = {}
+	with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(init_fn, init_args)) as executor:
+		futures = [executor.submit(_process_chunk, process_fn, i, chunk) for i, chunk in enumerate(chunks)]
+		with tqdm(total=len(items), disable=not verbose) as pbar:
+			for future in as_completed(futures):
+				chunk_idx, chunk_results, pid, elapsed = future.result()
+				results[chunk_idx] = chunk_results
+				worker = stats.setdefault(pid, {"items": 0, "time": 0.0})
+				worker["items"] += len(chunk_results)
+				worker["time"] += elapsed
+				pbar.update(len(chunk_results))
+	for worker in stats.values():
+		worker["throughput"] = worker["items"] / worker["time"] if worker["time"] > 0 else float("inf")
+	return [result for chunk_results in results for result in chunk_results], stats
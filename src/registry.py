@@ -0,0 +1,154 @@
+import os
+import threading
+from time import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
+import spacy
+
+SPACY_MODELS = {"es": "es_core_news_sm", "ca": "ca_core_news_sm"}
+
+# Components needed for each task, requesting a task loads only these pipes
+PIPE_GROUPS = {
+	"tokenizer": (),
+	"tagger": ("tok2vec", "morphologizer", "attribute_ruler"),
+	"lemmatizer": ("tok2vec", "morphologizer", "attribute_ruler", "lemmatizer")
+}
+
+_lock = threading.RLock()
+_models = {}
+_stats = {}
+_versions = {}
+
+def _rss_mb() -> Optional[float]:
+	"""
+	Returns the resident memory of the process in MB, or None if it can not be read.
+	"""
+	try:
+		with open("/proc/self/statm", "r") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+	except (OSError, ValueError, AttributeError):
+		try:
+			import resource # peak memory, only available on Unix
+			return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+		except ImportError:
+			return None
+
+def get_model(
+		key: Any,
+		loader: Callable[[], Any],
+		version: Any = None
+) -> Any:
+	"""
+	Returns the model registered under key, calling loader the first time it is requested.
+	If version differs from the one the model was loaded with (e.g. the mtime of its files),
+	the model is loaded again and replaces the previous one.
+		Load time and resident memory increase are recorded in the registry stats.
+	"""
+	with _lock:
+		if key not in _models or _versions.get(key) != version:
+			rss = _rss_mb()
+			start = time()
+			_models[key] = loader()
+			_versions[key] = version
+			rss_after = _rss_mb()
+			_stats[key] = {
+				"load_time": round(time() - start, 4),
+				"rss_mb": None if rss is None else round(rss_after - rss, 2)
+			}
+		return _models[key]
+
+def _resolve_pipes(
+		pipes: Union[None, str, Iterable[str]]
+) -> Optional[frozenset]:
+	"""
+	Turns a task name or a list of tasks / component names into a set of components.
+		None means the whole pipeline.
+	"""
+	if pipes is None:
+		return None
+	if isinstance(pipes, str):
+		pipes = [pipes]
+	components = set()
+	for pipe in pipes:
+		components.update(PIPE_GROUPS.get(pipe, (pipe,)))
+	return frozenset(components)
+
+def get_nlp(
+		lang: str,
+		pipes: Union[None, str, Iterable[str]] = None
+) -> Any:
+	"""
+	Returns the shared spacy model of a language ("es" or "ca").
+	The model may be handed to any other caller of the process, possibly with more
+	components than requested: treat it as read-only. Do not disable, remove or add
+	components (see preprocessing.run_pipes to skip some), and do not reconfigure it
+	while other threads may be using it.
+	Parameters:
+	- lang: language of the model.
+	- pipes: task ("tokenizer", "tagger", "lemmatizer") or list of tasks / component names
+		needed by the caller. The other components are excluded when loading. If None,
+		the whole pipeline is loaded.
+
+	A model already loaded with all the requested components is reused.
+	"""
+	name = SPACY_MODELS.get(lang, lang)
+	needed = _resolve_pipes(pipes)
+	with _lock:
+		for (kind, _name, loaded), nlp in _models.items():
+			if kind == "spacy" and _name == name and (loaded is None or (needed is not None and needed <= loaded)):
+				return nlp
+		def loader():
+			if needed is None:
+				return spacy.load(name)
+			meta = spacy.util.get_model_meta(spacy.util.get_package_path(name))
+			components = meta.get("components", meta.get("pipeline", []))
+			return spacy.load(name, exclude=[c for c in components if c not in needed])
+		return get_model(("spacy", name, needed), loader)
+
+def get_nlps(
+		pipes: Union[None, str, Iterable[str]] = None
+) -> Tuple[Any, Any]:
+	"""
+	Returns the shared Spanish and Catalan spacy models (see get_nlp).
+	"""
+	return get_nlp("es", pipes), get_nlp("ca", pipes)
+
+def get_fasttext(
+		lang: str = "es"
+) -> Any:
+	"""
+	Returns the shared FastText model of a language, downloading it if needed.
+	"""
+	def loader():
+		import fasttext
+		import fasttext.util
+		fasttext.util.download_model(lang, if_exists="ignore")
+		return fasttext.load_model(f"cc.{lang}.300.bin")
+	return get_model(("fasttext", lang, None), loader)
+
+def spacy_versions() -> Dict[str, Optional[str]]:
+	"""
+	Returns the installed version of spacy and of each spacy model, without loading them.
+	"""
+	versions = {"spacy": spacy.__version__}
+	for name in SPACY_MODELS.values():
+		versions[name] = spacy.util.get_package_version(name)
+	return versions
+
+def stats() -> Dict[str, Dict[str, Optional[float]]]:
+	"""
+	Returns the load time (s) and resident memory increase (MB) of each loaded model.
+	"""
+	with _lock:
+		return {
+			f"{kind}:{name}" + (f"[{','.join(sorted(pipes))}]" if pipes is not None else ""): dict(s)
+			for (kind, name, pipes), s in _stats.items()
+		}
+
+def clear() -> None:
+	"""
+	Forget all the loaded models, they will be loaded again on the next request.
+	"""
+	with _lock:
+		_models.clear()
+		_stats.clear()
+		_versions.clear()
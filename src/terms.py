@@ -0,0 +1,103 @@
+import os
+import numpy as np
+from typing import Iterable, List, Optional, Tuple
+from preprocessing import read_terms
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+class TermTrie:
+	def __init__(
+			self,
+			terms: Iterable[str]
+	):
+		"""
+		Token trie over medical terms (split on whitespace), to find all the terms
+		of a sentence in a single left-to-right pass over its tokens.
+		"""
+		self.root = {}
+		self.size = 0
+		for term in terms:
+			words = term.split()
+			node = self.root
+			for word in words:
+				node = node.setdefault(word, {})
+			if None not in node:
+				node[None] = len(words) # end of a term
+				self.size += 1
+
+	def __len__(self) -> int:
+		return self.size
+
+	def first_words(self) -> List[str]:
+		"""
+		Returns the words that start a term.
+		"""
+		return list(self.root)
+
+	def find(
+			self,
+			tokens: np.ndarray,
+			starts: Optional[Iterable[int]] = None
+	) -> List[Tuple[int, int]]:
+		"""
+		Returns the start and end (exclusive) token indices of every term in the tokens,
+		including overlapping ones. If starts is given, only terms starting at those indices
+		are looked for.
+		"""
+		matches = []
+		for start in (range(len(tokens)) if starts is None else starts):
+			node = self.root
+			for end in range(start, len(tokens)):
+				node = node.get(tokens[end])
+				if node is None:
+					break
+				if None in node:
+					matches.append((start, end + 1))
+		return matches
+
+class TermExtractor:
+	def __init__(
+			self,
+			terms_path: Optional[str] = None,
+			terms: Optional[Iterable[str]] = None
+	):
+		"""
+		In-process medical term extractor over a term lexicon, replacing the CUTEXT jar
+		(deprecated.cutext): the lexicon is loaded once into a token trie and sentences are
+		matched in memory, without temporary files or a JVM per call.
+		Parameters:
+		- terms_path: file with a term per line, tokens separated by spaces.
+			Defaults to data/medical_terms.txt.
+		- terms: terms to use instead of reading terms_path.
+		"""
+		if terms is None:
+			if terms_path is None:
+				terms_path = os.path.join(DATA_DIR, "medical_terms.txt")
+			terms = read_terms(terms_path)
+		self.trie = TermTrie(term for term in terms if term.strip())
+		self.first_words = set(self.trie.first_words())
+
+	def get_medical_terms(
+			self,
+			tokens: np.ndarray
+	) -> List[List[str]]:
+		"""
+		Returns the medical terms present in the tokens, split in tokens, in order of
+		first appearance and without repetitions (same contract as
+		cutextNegex.get_medical_terms).
+		"""
+		starts = [i for i, token in enumerate(tokens) if token in self.first_words]
+		terms = {}
+		for start, end in self.trie.find(tokens, starts):
+			term = tuple(str(token) for token in tokens[start:end])
+			terms.setdefault(term, None)
+		return [list(term) for term in terms]
+
+	def get_medical_terms_batch(
+			self,
+			tokens_list: List[np.ndarray]
+	) -> List[List[List[str]]]:
+		"""
+		Returns the medical terms of each token array (see get_medical_terms).
+		"""
+		return [self.get_medical_terms(tokens) for tokens in tokens_list]
@@ -0,0 +1,122 @@
+import json
+import os
+import re
+import pytest
+import blindNegex
+from blindNegex import BoundaryIndex, CueMatcher, backward_scope, fordward_scope, process_stream, read_negations,\
+    tag_negations, write_checkpoint
+
+NEGATIONS = {"no": "[PREN]", "descartado": "[POST]"}
+
+def scopes(result):
+    return [(r["value"]["start"], r["value"]["end"]) for r in result if r["value"]["labels"] in (["[NSCO]"], ["[USCO]"])]
+
+def test_forward_matches_scan():
+    text = "no fiebre. no tos. dolor no"
+    index = BoundaryIndex(text)
+    for start in range(len(text) + 1):
+        assert index.forward(start) == fordward_scope(text, start)
+        assert index.forward(start) >= start
+
+def test_backward_matches_scan():
+    text = "fiebre. tos descartado. dolor"
+    index = BoundaryIndex(text)
+    for end in range(len(text)):
+        assert index.backward(end) == backward_scope(text, end)
+
+def test_cue_at_end_of_text():
+    text = "paciente con fiebre, no"
+    assert scopes(tag_negations(text, NEGATIONS)) == [(len(text), len(text))]
+
+def test_cue_before_boundary():
+    text = "tos no. fiebre"
+    assert scopes(tag_negations(text, NEGATIONS)) == [(6, 6)]
+
+def test_forward_scope():
+    text = "no fiebre ni tos. dolor"
+    assert scopes(tag_negations(text, NEGATIONS)) == [(2, 15)]
+
+TEXTS = ["no fiebre. tos descartado.", "dolor agudo, no irradiado.", "sin cambios. ñandú no visto.", "fiebre descartado", "no tos"]
+
+def documents():
+    return [{"data": {"text": text}, "predictions": [{"result": []}]} for text in TEXTS]
+
+def write_input(path, newline="\n"):
+    if str(path).endswith(".jsonl"):
+        content = newline.join(json.dumps(doc, ensure_ascii=False) for doc in documents()) + newline
+    else:
+        content = "[" + newline + ("," + newline).join(json.dumps(doc, ensure_ascii=False, indent=1).replace("\n", newline)\
+                                                      for doc in documents()) + newline + "]" + newline
+    with open(path, "w", encoding="utf8", newline="") as f:
+        f.write(content)
+
+def run_interrupted(monkeypatch, input_file, output_file, checkpoint_file, fail_at):
+    calls = [0]
+    def failing(*args):
+        calls[0] += 1
+        if calls[0] == fail_at:
+            raise KeyboardInterrupt
+        return tag_negations(*args)
+    monkeypatch.setattr(blindNegex, "tag_negations", failing)
+    with pytest.raises(KeyboardInterrupt):
+        process_stream(input_file, output_file, NEGATIONS, checkpoint_file, checkpoint_every=2)
+    monkeypatch.setattr(blindNegex, "tag_negations", tag_negations)
+    return process_stream(input_file, output_file, NEGATIONS, checkpoint_file, checkpoint_every=2)
+
+@pytest.mark.parametrize("name, newline", [("in.jsonl", "\n"), ("in.jsonl", "\r\n"), ("in.json", "\n"), ("in.json", "\r\n")])
+def test_process_stream_resume(tmp_path, monkeypatch, name, newline):
+    input_file = str(tmp_path / name)
+    write_input(input_file, newline)
+    expected = str(tmp_path / ("expected" + os.path.splitext(name)[1]))
+    assert process_stream(input_file, expected, NEGATIONS) == len(TEXTS)
+
+    output_file = str(tmp_path / ("out" + os.path.splitext(name)[1]))
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    assert run_interrupted(monkeypatch, input_file, output_file, checkpoint_file, fail_at=4) == len(TEXTS)
+    with open(expected, "rb") as f, open(output_file, "rb") as g:
+        assert f.read() == g.read()
+    assert not os.path.exists(checkpoint_file)
+
+def test_process_stream_output(tmp_path):
+    input_file = str(tmp_path / "in.json")
+    write_input(input_file, "\r\n")
+    output_file = str(tmp_path / "out.json")
+    process_stream(input_file, output_file, NEGATIONS)
+    with open(output_file, "r", encoding="utf8") as f:
+        results = [doc["predictions"][0]["result"] for doc in json.load(f)]
+    assert results == [tag_negations(text, NEGATIONS) for text in TEXTS]
+
+def test_process_stream_resume_without_output(tmp_path):
+    input_file = str(tmp_path / "in.json")
+    write_input(input_file)
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    write_checkpoint(checkpoint_file, {"documents": 2, "input_offset": 10, "output_offset": 10})
+    output_file = str(tmp_path / "out.json")
+    assert process_stream(input_file, output_file, NEGATIONS, checkpoint_file) == len(TEXTS)
+    with open(output_file, "r", encoding="utf8") as f:
+        assert len(json.load(f)) == len(TEXTS)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+def find_all_regex(text, negations):
+    occurrences = {}
+    for negation in negations:
+        matches = [(m.start(), m.end()) for m in re.finditer(r"\b" + re.escape(negation) + r"\b", text)]
+        if matches:
+            occurrences[negation] = matches
+    return occurrences
+
+def test_cue_matcher_matches_regex():
+    negations = read_negations(os.path.join(DATA_DIR, "negation_speculation_word.txt"))
+    matcher = CueMatcher(negations)
+    texts = [
+        "no no. sin fiebre, descartándose neumonía; nono no-tos (no) negativo",
+        "niega dolor.niega fiebre y no se observa ninguna lesión sin sin",
+        "àno ñno no_ no1 1no NO"
+    ]
+    with open(os.path.join(DATA_DIR, "test_data.json"), "r", encoding="utf8") as f:
+        texts += [doc["data"]["text"] for doc in json.load(f)]
+    for text in texts:
+        found = matcher.find_all(text)
+        assert found == find_all_regex(text, negations)
+        assert list(found) == list(find_all_regex(text, negations))
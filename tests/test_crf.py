@@ -0,0 +1,30 @@
+import numpy as np
+from crf import create_bio_tags
+
+def sentence(tokens, spans):
+	return {"tokens": np.array(tokens), "spans": np.array(spans)}
+
+# "No tiene fiebre. Niega dolor."
+DOC_TOKENS = [
+	sentence(["No", "tiene", "fiebre"], [[0, 2], [3, 8], [9, 15]]),
+	sentence(["Niega", "dolor"], [[17, 22], [23, 28]])
+]
+
+def document(*spans):
+	return {"predictions": [{"result": [{"value": {"start": start, "end": end, "labels": [label]}} for start, end, label in spans]}]}
+
+def test_bio_tags():
+	doc = document((0, 2, "NEG"), (3, 15, "NSCO"), (17, 22, "NEG"), (23, 28, "NSCO"))
+	assert create_bio_tags([doc], [DOC_TOKENS]) == [[["B-NEG", "B-NSCO", "I-NSCO"], ["B-NEG", "B-NSCO"]]]
+
+def test_partial_tokens_are_not_tagged():
+	doc = document((4, 15, "UNC"))
+	assert create_bio_tags([doc], [DOC_TOKENS]) == [[["O", "O", "B-UNC"], ["O", "O"]]]
+
+def test_span_across_sentences_tags_first_sentence():
+	doc = document((3, 15, "NSCO"), (9, 28, "USCO"))
+	assert create_bio_tags([doc], [DOC_TOKENS]) == [[["O", "B-NSCO", "B-USCO"], ["O", "O"]]]
+
+def test_other_labels_are_ignored():
+	doc = document((0, 28, "OTHER"))
+	assert create_bio_tags([doc], [DOC_TOKENS]) == [[["O", "O", "O"], ["O", "O"]]]
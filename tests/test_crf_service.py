@@ -0,0 +1,89 @@
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+import pycrfsuite as crfs
+import pytest
+import spacy
+from crf_service import CRFService, serve_http, serve_stdio
+
+def fake_tag_batch(texts):
+	if "boom" in texts:
+		raise IndexError("boom")
+	return [[{"text": text}] for text in texts]
+
+@pytest.fixture
+def service(tmp_path):
+	trainer = crfs.Trainer(verbose=False)
+	trainer.append([["w=no"], ["w=fiebre"]], ["B-NEG", "B-NSCO"])
+	trainer.train(str(tmp_path / "model.crfsuite"))
+	service = CRFService(str(tmp_path / "model.crfsuite"), nlps=(spacy.blank("es"), spacy.blank("ca")), max_wait=0.2)
+	# tagging is tested with the CRF, here only the request handling matters
+	service.tag_batch = fake_tag_batch
+	yield service
+	service.close()
+
+def test_submit_rejects_bad_texts(service):
+	with pytest.raises(TypeError):
+		service.submit(3)
+	with pytest.raises(ValueError):
+		service.submit(" \n")
+	assert service.tag("no fiebre") == [{"text": "no fiebre"}]
+
+def test_failing_request_does_not_fail_its_batch(service):
+	futures = [service.submit(text) for text in ("a", "boom", "b")]
+	assert futures[0].result(5) == [{"text": "a"}]
+	with pytest.raises(IndexError):
+		futures[1].result(5)
+	assert futures[2].result(5) == [{"text": "b"}]
+
+def test_submit_after_close(service):
+	service.close()
+	with pytest.raises(RuntimeError):
+		service.submit("no fiebre")
+
+def test_serve_stdio_errors(service):
+	lines = [
+		json.dumps({"id": 1, "text": "a"}),
+		"not json",
+		json.dumps([1, 2]),
+		json.dumps({"id": 2, "text": "  "}),
+		json.dumps({"id": 3, "text": "boom"}),
+		json.dumps({"id": 4, "text": "b"})
+	]
+	output = io.StringIO()
+	serve_stdio(service, io.StringIO("\n".join(lines) + "\n"), output)
+	responses = [json.loads(line) for line in output.getvalue().splitlines()]
+	assert [response["id"] for response in responses] == [1, None, None, 2, 3, 4]
+	assert responses[0]["result"] == [{"text": "a"}]
+	assert all("error" in response for response in responses[1:5])
+	assert responses[5]["result"] == [{"text": "b"}]
+
+def post(url, body):
+	request = urllib.request.Request(url, data=body if isinstance(body, bytes) else json.dumps(body).encode("utf-8"))
+	try:
+		with urllib.request.urlopen(request, timeout=10) as response:
+			return response.status, json.load(response)
+	except urllib.error.HTTPError as e:
+		return e.code, json.load(e)
+
+def test_http_errors(service):
+	server = serve_http(service, port=0)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = f"http://127.0.0.1:{server.server_port}"
+	try:
+		assert post(url + "/tag", {"text": "a"}) == (200, {"result": [{"text": "a"}]})
+		assert post(url + "/tag", {"texts": ["a", "b"]}) == (200, {"results": [[{"text": "a"}], [{"text": "b"}]]})
+		assert post(url + "/tag", {"text": 5})[0] == 400
+		assert post(url + "/tag", {"texts": ["a", " "]})[0] == 400
+		assert post(url + "/tag", {"texts": "a"})[0] == 400
+		assert post(url + "/tag", [1])[0] == 400
+		assert post(url + "/tag", b"not json")[0] == 400
+		assert post(url + "/tag", {"text": "boom"})[0] == 500
+		assert post(url + "/other", {"text": "a"})[0] == 404
+		service.close()
+		assert post(url + "/tag", {"text": "a"})[0] == 503
+	finally:
+		server.shutdown()
+		server.server_close()
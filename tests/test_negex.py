@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from negex import NegexEngine, get_indices
+
+# post-cues first, so the position of a cue in the lexicon differs from its position in a sentence
+LEXICON = "descartado\t\t[POST]\ndudoso\t\t[POSP]\nsin\t\t[PREN]\nposible\t\t[PREP]\n"
+TERMS = "fiebre\ntos\nneumonia\ndolor abdominal\n"
+
+@pytest.fixture
+def engine(tmp_path):
+	(tmp_path / "terms.txt").write_text(TERMS, encoding="utf8")
+	(tmp_path / "cues.txt").write_text(LEXICON, encoding="utf8")
+	return NegexEngine(str(tmp_path / "terms.txt"), str(tmp_path / "cues.txt"))
+
+def sentence(text):
+	tokens, spans, start = [], [], 0
+	for token in text.split():
+		start = text.index(token, start)
+		tokens.append(token)
+		spans.append([start, start + len(token)])
+		start += len(token)
+	return {"tokens": np.array(tokens), "spans": np.array(spans), "lang": "es"}
+
+def results(engine, text):
+	return [(r["value"]["start"], r["value"]["end"], r["value"]["labels"][0]) for r in engine.process_doc([sentence(text)])["result"]]
+
+def test_cue_directions(engine):
+	tokens = np.array(["fiebre", "descartado", "sin", "tos", "posible", "neumonia", "dudoso"])
+	neg_idx, neg_dir, unc_idx, unc_dir, _, _ = get_indices(tokens, None, engine.negation_words, engine.negation_dirs,\
+		engine.speculation_words, engine.speculation_dirs, engine.lexicon)
+	assert neg_idx.tolist() == [1, 2] and neg_dir.tolist() == [-1, 1]
+	assert unc_idx.tolist() == [4, 6] and unc_dir.tolist() == [1, -1]
+
+def test_pre_negation(engine):
+	assert results(engine, "sin dolor abdominal") == [(4, 19, "NEG")]
+
+def test_post_negation(engine):
+	assert results(engine, "fiebre descartado") == [(0, 6, "NEG")]
+
+def test_pre_speculation(engine):
+	assert results(engine, "posible neumonia") == [(8, 16, "SPEC")]
+
+def test_post_speculation(engine):
+	assert results(engine, "tos dudoso") == [(0, 3, "SPEC")]
+
+def test_cue_without_context_is_dropped(engine):
+	assert results(engine, "descartado fiebre") == []
+	assert engine.stats == {"sentences": 1, "failed": 1}